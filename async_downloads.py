@@ -0,0 +1,116 @@
+import os
+import asyncio
+import logging
+import importlib.util
+from supabase_client import supabase_headers, get_timeout, RETRY_STATUS_CODES
+from receipt_cache import response_validators
+from run_metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Asynchrone Download-Engine für den Supabase Storage (httpx, optional mit HTTP/2).
+# Wird von ReceiptPipeline mit RECEIPT_DOWNLOAD_ENGINE=async anstelle der Download-Threads verwendet.
+
+# Funktion zum Prüfen, ob httpx installiert ist
+def async_engine_available():
+    return importlib.util.find_spec('httpx') is not None
+
+# Funktion zum Prüfen, ob HTTP/2 (Paket h2) verfügbar ist
+def http2_available():
+    return importlib.util.find_spec('h2') is not None
+
+# Funktion zum Ermitteln der Wartezeit aus dem Retry-After-Header (Sekunden)
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+# Funktion zum Herunterladen eines Objekts als Stream. Mit target_path wird direkt in die
+# Zieldatei geschrieben, sonst werden die Bytes im Speicher gesammelt.
+# Gibt (status, content, validators) zurück; status 304 bei unverändertem Objekt.
+async def fetch_object(client, semaphore, storage_path, target_path, retries, backoff, headers=None):
+    import httpx
+
+    url = f"{os.getenv('SUPABASE_URL')}/storage/v1/object/{storage_path}"
+    attempt = 0
+    while True:
+        async with semaphore:
+            try:
+                async with client.stream('GET', url, headers=headers) as response:
+                    if response.status_code == 304:
+                        return 304, None, None
+                    if response.status_code == 200:
+                        validators = response_validators(response.headers)
+                        if target_path is None:
+                            return 200, await response.aread(), validators
+                        part_path = f"{target_path}.part"
+                        with open(part_path, 'wb') as f:
+                            async for chunk in response.aiter_bytes():
+                                f.write(chunk)
+                        os.replace(part_path, target_path)
+                        return 200, None, validators
+                    body = await response.aread()
+                    if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                        raise RuntimeError(f"{response.status_code} - {body.decode(errors='replace')}")
+                    delay = retry_after_seconds(response) or backoff * 2 ** attempt
+            except httpx.TransportError:
+                if attempt >= retries:
+                    raise
+                delay = backoff * 2 ** attempt
+        attempt += 1
+        await asyncio.sleep(delay)
+
+async def _download_all(jobs, concurrency, label, on_result, cache, metrics):
+    import httpx
+
+    connect_timeout, read_timeout = get_timeout()
+    retries = int(os.getenv("SUPABASE_RETRIES", 5))
+    backoff = float(os.getenv("SUPABASE_BACKOFF", 0.5))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(http2=http2_available(), headers=supabase_headers(),
+                                 limits=limits, timeout=timeout) as client:
+        async def download(job):
+            storage_path, local_pdf_path, _, _, _ = job
+            # PDFs direkt auf die Festplatte streamen, Bilder für die Umwandlung im Speicher halten
+            target_path = local_pdf_path if storage_path.lower().endswith('.pdf') else None
+            logger.debug("Versuche, %s herunterzuladen von: %s", label, storage_path)
+            content = None
+            validators = None
+            error = None
+            try:
+                with timed(metrics, "receipt_download") as timer:
+                    headers = cache.conditional_headers(storage_path) if cache is not None else None
+                    status, content, validators = await fetch_object(
+                        client, semaphore, storage_path, target_path, retries, backoff, headers)
+                    if status == 304:
+                        if await asyncio.to_thread(cache.restore, storage_path, local_pdf_path):
+                            if metrics is not None:
+                                metrics.count("receipt_not_modified")
+                            logger.debug("%s unverändert, aus dem Cache übernommen: %s", label, local_pdf_path)
+                        else:
+                            status, content, validators = await fetch_object(
+                                client, semaphore, storage_path, target_path, retries, backoff)
+                    if content is not None:
+                        timer.bytes = len(content)
+                    elif status == 200:
+                        timer.bytes = os.path.getsize(target_path)
+                if status == 200 and target_path is not None and cache is not None:
+                    await asyncio.to_thread(cache.store, storage_path, validators, None, target_path)
+            except Exception as e:
+                error = e
+            # Der Callback kann an einer vollen Warteschlange blockieren, daher ausserhalb der Event-Loop
+            await asyncio.to_thread(on_result, job, content, validators, error)
+
+        await asyncio.gather(*(download(job) for job in jobs))
+
+# Funktion zum Herunterladen aller Aufträge mit begrenzter Nebenläufigkeit.
+# on_result(job, content, validators, error) wird pro Auftrag aufgerufen, sobald er fertig ist
+# (content enthält die Bild-Bytes oder None, wenn das PDF bereits fertig gespeichert ist).
+# Mit metrics wird jeder Download als "receipt_download" erfasst.
+def download_jobs(jobs, concurrency, label, on_result, cache=None, metrics=None):
+    asyncio.run(_download_all(jobs, concurrency, label, on_result, cache, metrics))
@@ -0,0 +1,193 @@
+import re
+import time
+import hashlib
+import itertools
+import threading
+
+# Ersatz für die Google Drive v3 API im Prozess (Schnittstelle wie googleapiclient:
+# files().get/list/create/update, new_batch_http_request, next_chunk für Resumable Uploads).
+# Jeder Aufruf wartet die eingestellte Latenz ab, ein Batch-Request zählt als ein Roundtrip.
+# Zählt Aufrufe pro Methode und die hochgeladenen Bytes, gruppiert nach tag() (z. B. der
+# aktuellen Phase des Benchmarks). Unbekannte Eltern-/Datei-IDs werden wie bei Drive mit 404 abgelehnt.
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Fehler wie googleapiclient.errors.HttpError (nur resp.status wird ausgewertet)
+class FakeHttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"<HttpError {status}: {message}>")
+        self.resp = type('FakeResponse', (), {'status': status})()
+
+class FakeDrive:
+    def __init__(self, latency=0.0, page_size=1000, tag=None):
+        self.latency = latency
+        self.tag = tag or (lambda: 'total')
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.calls = {}
+        self.bytes_uploaded = {}
+
+    # Ein Roundtrip zur API (Latenz und Zähler)
+    def roundtrip(self, method):
+        if self.latency:
+            time.sleep(self.latency)
+        tag = self.tag()
+        with self.lock:
+            calls = self.calls.setdefault(tag, {})
+            calls[method] = calls.get(method, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'calls': {tag: dict(calls) for tag, calls in self.calls.items()},
+                'bytes_uploaded': dict(self.bytes_uploaded)
+            }
+
+    # Liefert einen neuen Dienst (wie build_drive_service, einer pro Thread)
+    def service(self):
+        return FakeService(self)
+
+    def media_bytes(self, media):
+        with open(media._filename, 'rb') as f:
+            content = f.read()
+        tag = self.tag()
+        with self.lock:
+            self.bytes_uploaded[tag] = self.bytes_uploaded.get(tag, 0) + len(content)
+        return content
+
+    def list_files(self, q, page_token):
+        parent = re.search(r"'([^']+)' in parents", q)
+        name = re.search(r"name='((?:[^'\\]|\\.)*)'", q)
+        folders_only = f"mimeType='{FOLDER_MIME_TYPE}'" in q
+        with self.lock:
+            matches = [
+                dict(file) for file in self.files.values()
+                if (not folders_only or file['mimeType'] == FOLDER_MIME_TYPE)
+                and (not parent or parent.group(1) in file['parents'])
+                and (not name or file['name'] == name.group(1))
+            ]
+        start = int(page_token or 0)
+        response = {'files': matches[start:start + self.page_size]}
+        if start + self.page_size < len(matches):
+            response['nextPageToken'] = str(start + self.page_size)
+        return response
+
+    # Löscht eine Datei bzw. einen Ordner samt Inhalt (wie von Hand in Drive)
+    def delete_file(self, file_id):
+        with self.lock:
+            stale = {file_id}
+            while True:
+                children = [child_id for child_id, file in self.files.items()
+                            if child_id not in stale and stale & set(file['parents'])]
+                if not children:
+                    break
+                stale.update(children)
+            for stale_id in stale:
+                self.files.pop(stale_id, None)
+
+    def create_file(self, body, content=None):
+        with self.lock:
+            for parent_id in body.get('parents', []):
+                if parent_id != 'root' and parent_id not in self.files:
+                    raise FakeHttpError(404, f"File not found: {parent_id}")
+            file_id = f"file{next(self.ids)}"
+            file = {
+                'id': file_id,
+                'name': body['name'],
+                'parents': body.get('parents', ['root']),
+                'mimeType': body.get('mimeType', 'application/octet-stream')
+            }
+            if content is not None:
+                file['md5Checksum'] = hashlib.md5(content).hexdigest()
+            self.files[file_id] = file
+            return dict(file)
+
+    def update_file(self, file_id, content):
+        with self.lock:
+            if file_id not in self.files:
+                raise FakeHttpError(404, f"File not found: {file_id}")
+            file = self.files[file_id]
+            file['md5Checksum'] = hashlib.md5(content).hexdigest()
+            return dict(file)
+
+class FakeStatus:
+    def __init__(self, resumable_progress, total_size):
+        self.resumable_progress = resumable_progress
+        self.total_size = total_size
+
+    def progress(self):
+        return self.resumable_progress / self.total_size if self.total_size else 1.0
+
+class FakeRequest:
+    def __init__(self, drive, method, run, media=None):
+        self.drive = drive
+        self.method = method
+        self.run = run
+        self.media = media
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self._in_error_state = False
+
+    def execute(self, num_retries=0):
+        self.drive.roundtrip(self.method)
+        content = self.drive.media_bytes(self.media) if self.media is not None else None
+        return self.run(content)
+
+    # Resumable Upload: ein Roundtrip pro Block, die Antwort kommt mit dem letzten Block
+    def next_chunk(self, num_retries=0):
+        size = self.media.size()
+        if self.resumable_uri is None:
+            self.drive.roundtrip(f"{self.method}_session")
+            self.resumable_uri = f"fake://upload/{id(self)}"
+        self.drive.roundtrip(f"{self.method}_chunk")
+        self.resumable_progress = min(size, self.resumable_progress + self.media.chunksize())
+        if self.resumable_progress < size:
+            return FakeStatus(self.resumable_progress, size), None
+        return None, self.run(self.drive.media_bytes(self.media))
+
+class FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.drive.roundtrip('batch')
+        for request_id, request in self.requests:
+            try:
+                response = request.run(None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+class FakeFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, fileId, fields=None):
+        return FakeRequest(self.drive, 'get', lambda content: {'id': fileId})
+
+    def list(self, q, spaces=None, fields=None, pageSize=None, pageToken=None):
+        return FakeRequest(self.drive, 'list', lambda content: self.drive.list_files(q, pageToken))
+
+    def create(self, body, media_body=None, fields=None):
+        return FakeRequest(self.drive, 'create', lambda content: self.drive.create_file(body, content), media_body)
+
+    def update(self, fileId, media_body=None, fields=None, body=None):
+        return FakeRequest(self.drive, 'update', lambda content: self.drive.update_file(fileId, content), media_body)
+
+class FakeService:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return FakeFiles(self.drive)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.drive, callback)
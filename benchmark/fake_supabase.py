@@ -0,0 +1,200 @@
+import io
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, unquote
+
+# Lokaler Ersatz für PostgREST und den Supabase Storage: liefert synthetische Tabellen
+# (purchases, expenses, campaigns) und Beleg-Dateien mit einstellbarer Latenz.
+# Unterstützt select=, order=created_date_time.asc,id.asc, limit=, den Keyset-Filter (or=),
+# gte./lt./eq./in./not.is.null-Filter und bedingte GETs (ETag / If-None-Match).
+
+KEYSET_PATTERN = re.compile(
+    r'\(created_date_time\.gt\."(?P<created>.*?)",and\(created_date_time\.eq\."(?P=created)",id\.gt\.(?P<id>.*)\)\)'
+)
+
+# Funktion zum Erzeugen eines Beleg-Bildes (JPEG mit Rauschen, damit die Grösse realistisch ist)
+def make_receipt_image(width, height, seed):
+    from PIL import Image
+
+    rng = random.Random(seed)
+    image = Image.frombytes('L', (width, height), bytes(rng.getrandbits(8) for _ in range(width * height)))
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+# Funktion zum Erzeugen eines minimalen PDF-Belegs
+def make_receipt_pdf(size):
+    body = b"%PDF-1.4\n%" + b"0" * max(0, size - 32) + b"\n%%EOF\n"
+    return body
+
+# Funktion zum Erzeugen der synthetischen Tabellen: rows Zeilen pro Tabelle, davon receipts mit
+# Beleg, verteilt auf keys Gruppierungsschlüssel und months Monate
+def make_tables(rows, receipts, keys, months, seed=1):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, 8, 0, 0)
+    with_receipt = set(rng.sample(range(1, rows + 1), min(receipts, rows)))
+    tables = {'purchases': [], 'expenses': [], 'campaigns': []}
+    for row_id in range(1, rows + 1):
+        created = start + timedelta(days=rng.randrange(months * 30), seconds=rng.randrange(86400),
+                                    microseconds=rng.randrange(1000000))
+        created_date_time = created.strftime('%Y-%m-%dT%H:%M:%S.%f') + '+00:00'
+        key = rng.randrange(keys)
+        # Jeder fünfte Beleg ist bereits ein PDF, die anderen sind Bilder
+        extension = 'pdf' if row_id % 5 == 0 else 'jpg'
+        # Jede Tabelle hat eigene Objekte, sonst träfe die zweite Tabelle nur noch den Beleg-Cache
+        path = f"{{table}}/{row_id}.{extension}" if row_id in with_receipt else None
+        account = rng.choice(['4000', '4200', '6500', '6600'])
+        kst = rng.choice(['100', '200', '300'])
+        project = rng.choice(['Sommer', 'Winter', 'Events'])
+        tables['purchases'].append({
+            'id': row_id, 'created_date_time': created_date_time, 'cardUsed': f"Karte {key}",
+            'invoiceIssuer': f"Lieferant {rng.randrange(50)}", 'itemName': f"Artikel {row_id} Beschreibung",
+            'account': account, 'kst': kst, 'project': project, 'vatRate': 8.1,
+            'price': round(rng.uniform(5, 500), 2), 'receiptPath': path and path.format(table='purchases'),
+            'notes': 'x' * 200
+        })
+        tables['expenses'].append({
+            'id': row_id, 'created_date_time': created_date_time, 'employeeName': f"Mitarbeiter {key}",
+            'date': created.strftime('%Y-%m-%d'), 'description': f"Spesen {row_id} Reise",
+            'amount': round(rng.uniform(5, 300), 2), 'account': account, 'kst': kst, 'project': project,
+            'bankName': 'Bank', 'iban': 'CH00 0000 0000 0000 0000 0', 'receiptPath': path and path.format(table='expenses'),
+            'notes': 'x' * 200
+        })
+        tables['campaigns'].append({
+            'id': row_id, 'created_date_time': created_date_time, 'employee': f"Mitarbeiter {key}",
+            'name': f"Kampagne {row_id} Social", 'startDate': created.strftime('%Y-%m-%d'),
+            'endDate': created.strftime('%Y-%m-%d'), 'adBudget': round(rng.uniform(100, 5000), 2),
+            'account': account, 'kst': kst, 'project': f"Projekt {key}", 'metaAccount': 'Meta',
+            'targetUrl': 'https://example.org', 'imagePath': path and path.format(table='campaigns'),
+            'notes': 'x' * 200
+        })
+    for table in tables.values():
+        table.sort(key=lambda row: (row['created_date_time'], row['id']))
+    return tables
+
+class FakeSupabase:
+    def __init__(self, tables, latency=0.0, image_size=(600, 800), pdf_size=50000):
+        self.tables = tables
+        self.latency = latency
+        self.image_size = image_size
+        self.pdf_size = pdf_size
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.requests = {'rest': 0, 'storage': 0, 'storage_not_modified': 0}
+        self.bytes_sent = {'rest': 0, 'storage': 0}
+        self.server = None
+
+    # Inhalt eines Storage-Objekts (wird beim ersten Zugriff erzeugt und behalten)
+    def object_bytes(self, path):
+        with self.lock:
+            content = self.objects.get(path)
+        if content is None:
+            seed = int(hashlib.md5(path.encode()).hexdigest()[:8], 16)
+            if path.endswith('.pdf'):
+                content = make_receipt_pdf(self.pdf_size)
+            else:
+                content = make_receipt_image(*self.image_size, seed)
+            with self.lock:
+                self.objects[path] = content
+        return content
+
+    def count(self, kind, size):
+        with self.lock:
+            self.requests[kind] += 1
+            if kind in self.bytes_sent:
+                self.bytes_sent[kind] += size
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'bytes_sent': dict(self.bytes_sent)}
+
+    # Beantwortet eine PostgREST-Abfrage
+    def query(self, table_name, params):
+        rows = self.tables.get(table_name, [])
+        limit = None
+        select = '*'
+        for name, value in params:
+            if name == 'limit':
+                limit = int(value)
+            elif name == 'select':
+                select = value
+            elif name == 'order':
+                continue
+            elif name == 'or':
+                match = KEYSET_PATTERN.match(value)
+                cursor = (match.group('created'), int(match.group('id')))
+                rows = [row for row in rows if (row['created_date_time'], row['id']) > cursor]
+            else:
+                operator, operand = value.split('.', 1)
+                if operator == 'gte':
+                    rows = [row for row in rows if str(row.get(name)) >= operand]
+                elif operator == 'lt':
+                    rows = [row for row in rows if str(row.get(name)) < operand]
+                elif operator == 'eq':
+                    rows = [row for row in rows if str(row.get(name)) == operand]
+                elif operator == 'in':
+                    wanted = set(operand.strip('()').split(','))
+                    rows = [row for row in rows if str(row.get(name)) in wanted]
+                elif operator == 'not' and operand == 'is.null':
+                    rows = [row for row in rows if row.get(name) is not None]
+        if limit is not None:
+            rows = rows[:limit]
+        if select != '*':
+            columns = select.split(',')
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                if url.path.startswith('/rest/v1/'):
+                    rows = fake.query(url.path[len('/rest/v1/'):], parse_qsl(url.query))
+                    body = json.dumps(rows).encode()
+                    fake.count('rest', len(body))
+                    self.respond(200, body, {'Content-Type': 'application/json'})
+                elif url.path.startswith('/storage/v1/object/'):
+                    path = unquote(url.path[len('/storage/v1/object/'):])
+                    content = fake.object_bytes(path)
+                    etag = '"' + hashlib.md5(content).hexdigest() + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        fake.count('storage_not_modified', 0)
+                        self.respond(304, headers={'ETag': etag})
+                        return
+                    fake.count('storage', len(content))
+                    self.respond(200, content, {'ETag': etag, 'Content-Type': 'application/octet-stream'})
+                else:
+                    self.respond(404)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
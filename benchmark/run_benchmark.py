@@ -0,0 +1,369 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+from datetime import datetime
+
+# Benchmark der Synchronisationen gegen lokale Ersatzdienste für Supabase (PostgREST und Storage)
+# und Google Drive mit einstellbarer Latenz. Misst pro Tabelle und Phase (fetch, group, render,
+# convert, upload) Laufzeit, API-Aufrufe, übertragene Bytes und den Spitzenwert des Speichers (RSS)
+# und schreibt die Ergebnisse als JSON, damit Läufe miteinander verglichen werden können.
+#
+#   python benchmark/run_benchmark.py --rows 2000 --receipts 400 --output benchmark_results.json
+#   python benchmark/run_benchmark.py --baseline benchmark_results.json
+#
+# Phasen: fetch = fetch_data, group = Aufbereitung bis zum Erstellen der Excel-Dateien (inkl.
+# Ordner-Auflösung und Zeilenspeicher), render = Warten auf die Excel-Dateien, convert =
+# Beleg-Pipeline (Download, Umwandlung, Upload überlappend), upload = Summe der Upload-Zeiten
+# (auch aus den Upload-Threads der Pipeline, überlappt daher mit convert).
+# Der erste Lauf startet leer, alle weiteren holen mit SYNC_FULL_REFRESH=1 alles erneut, ohne dass
+# sich etwas geändert hat (Abrechnungen und Belege sollten übersprungen werden).
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+PHASES = ['fetch', 'group', 'render', 'convert', 'upload']
+TABLES = ['purchases', 'expenses', 'campaigns']
+
+# Funktion zum Lesen des aktuellen Speicherverbrauchs (RSS) in Bytes, None wenn nicht verfügbar
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Funktion zum Lesen des bisherigen Spitzenwerts (RSS) in Bytes für den Prozess bzw. die Kindprozesse
+def max_rss(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux meldet KB, macOS Bytes
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+# Erfasst Zeiten, Speicher und die aktuelle Phase eines Synchronisationslaufs.
+# Die Phase gilt für den Hauptthread und die Pipeline-Threads; Uploads setzen sie pro Thread.
+class PhaseRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phase = None
+        self.group_started = None
+        self.seconds = {phase: 0.0 for phase in PHASES}
+        self.peak_rss = {}
+        self.uploads_active = 0
+        self.sampling = False
+
+    def current(self):
+        return getattr(self.local, 'phase', None) or self.phase or 'other'
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.seconds[phase] += seconds
+
+    def switch(self, phase):
+        self.sample()
+        self.phase = phase
+        self.sample()
+
+    # Beendet die Phase group (beim ersten Erstellen der Excel-Dateien bzw. beim Start der Pipeline)
+    def end_group(self):
+        if self.group_started is not None:
+            self.add('group', time.perf_counter() - self.group_started)
+            self.group_started = None
+
+    def sample(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        phases = [self.phase or 'other'] + (['upload'] if self.uploads_active else [])
+        with self.lock:
+            for phase in phases:
+                self.peak_rss[phase] = max(self.peak_rss.get(phase, 0), rss)
+
+    # Tastet den Speicherverbrauch im Hintergrund ab, solange der Lauf dauert
+    def start_sampling(self, interval=0.01):
+        self.sampling = True
+
+        def run():
+            while self.sampling:
+                self.sample()
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop_sampling(self, thread):
+        self.sampling = False
+        thread.join()
+
+# Instrumentiert die Synchronisationsmodule für den Benchmark: Ersatzdienste statt Google Drive,
+# Zeitmessung um fetch_data, render_reports, ReceiptPipeline.run und DriveUploader.upload
+class Instrumentation:
+    def __init__(self, drive):
+        self.drive = drive
+        self.recorder = PhaseRecorder()
+
+    def install(self, modules):
+        import receipts
+        import drive_uploads
+
+        for module in modules:
+            module.fetch_data = self.wrap_fetch(module.fetch_data)
+            module.render_reports = self.wrap_render(module.render_reports)
+            module.get_drive_service = self.drive.service
+            module.build_drive_service = self.drive.service
+        receipts.ReceiptPipeline.run = self.wrap_pipeline(receipts.ReceiptPipeline.run)
+        drive_uploads.DriveUploader.upload = self.wrap_upload(drive_uploads.DriveUploader.upload)
+
+    def wrap_fetch(self, fetch_data):
+        def wrapped(*args, **kwargs):
+            recorder = self.recorder
+            recorder.switch('fetch')
+            started = time.perf_counter()
+            try:
+                return fetch_data(*args, **kwargs)
+            finally:
+                recorder.add('fetch', time.perf_counter() - started)
+                recorder.switch('group')
+                recorder.group_started = time.perf_counter()
+        return wrapped
+
+    def wrap_render(self, render_reports):
+        def wrapped(reports, workers=None, **kwargs):
+            recorder = self.recorder
+            recorder.end_group()
+            results = render_reports(reports, workers, **kwargs)
+            while True:
+                recorder.switch('render')
+                started = time.perf_counter()
+                try:
+                    result = next(results)
+                except StopIteration:
+                    return
+                finally:
+                    recorder.add('render', time.perf_counter() - started)
+                    recorder.switch(None)
+                yield result
+        return wrapped
+
+    def wrap_pipeline(self, run):
+        def wrapped(pipeline, jobs):
+            recorder = self.recorder
+            recorder.end_group()
+            recorder.switch('convert')
+            started = time.perf_counter()
+            try:
+                return run(pipeline, jobs)
+            finally:
+                recorder.add('convert', time.perf_counter() - started)
+                recorder.switch(None)
+        return wrapped
+
+    def wrap_upload(self, upload):
+        def wrapped(uploader, file_path, file_name, folder_id):
+            recorder = self.recorder
+            recorder.local.phase = 'upload'
+            with recorder.lock:
+                recorder.uploads_active += 1
+            started = time.perf_counter()
+            try:
+                return upload(uploader, file_path, file_name, folder_id)
+            finally:
+                recorder.add('upload', time.perf_counter() - started)
+                with recorder.lock:
+                    recorder.uploads_active -= 1
+                recorder.local.phase = None
+        return wrapped
+
+# Funktion zum Bilden der Differenz zweier Zählerstände (verschachtelte dicts)
+def counter_delta(before, after):
+    delta = {}
+    for key, value in after.items():
+        if isinstance(value, dict):
+            nested = counter_delta(before.get(key, {}), value)
+            if nested:
+                delta[key] = nested
+        elif value - before.get(key, 0):
+            delta[key] = value - before.get(key, 0)
+    return delta
+
+def megabytes(value):
+    return round(value / 1024 / 1024, 1) if value is not None else None
+
+# Funktion zum Ausführen einer Synchronisation mit Messung; gibt das Ergebnis als dict zurück
+def run_table(table, job, instrumentation, supabase, drive):
+    recorder = PhaseRecorder()
+    instrumentation.recorder = recorder
+    supabase_before = supabase.snapshot()
+    drive_before = drive.snapshot()
+    sampler = recorder.start_sampling()
+    started = time.perf_counter()
+    try:
+        ok = job(drive.service(), None) is not False
+    except Exception as e:
+        print(f"Fehler bei der Synchronisation der Tabelle {table}: {e}", file=sys.stderr)
+        ok = False
+    wall = time.perf_counter() - started
+    recorder.end_group()
+    recorder.stop_sampling(sampler)
+
+    supabase_delta = counter_delta(supabase_before, supabase.snapshot())
+    drive_delta = counter_delta(drive_before, drive.snapshot())
+    requests = supabase_delta.get('requests', {})
+    bytes_sent = supabase_delta.get('bytes_sent', {})
+    phases = {}
+    for phase in PHASES:
+        phases[phase] = {
+            'seconds': round(recorder.seconds[phase], 3),
+            'drive_calls': drive_delta.get('calls', {}).get(phase, {}),
+            'drive_bytes_uploaded': drive_delta.get('bytes_uploaded', {}).get(phase, 0),
+            'peak_rss_mb': megabytes(recorder.peak_rss.get(phase)),
+        }
+    # Supabase-Anfragen lassen sich eindeutig zuordnen: PostgREST beim Holen, Storage in der Pipeline
+    phases['fetch']['supabase_requests'] = requests.get('rest', 0)
+    phases['fetch']['supabase_bytes'] = bytes_sent.get('rest', 0)
+    phases['convert']['supabase_requests'] = requests.get('storage', 0) + requests.get('storage_not_modified', 0)
+    phases['convert']['supabase_not_modified'] = requests.get('storage_not_modified', 0)
+    phases['convert']['supabase_bytes'] = bytes_sent.get('storage', 0)
+    return {
+        'ok': ok,
+        'wall_seconds': round(wall, 3),
+        'phases': phases,
+        'other_drive_calls': drive_delta.get('calls', {}).get('other', {}),
+        'peak_rss_mb': megabytes(max_rss()),
+        'peak_children_rss_mb': megabytes(max_rss(children=True)),
+    }
+
+# Funktion zum Vergleichen mit einem früheren Ergebnis (Laufzeiten pro Phase)
+def print_comparison(baseline, results):
+    print("Vergleich mit der Baseline (Sekunden, alt -> neu):")
+    for run, (old_run, new_run) in enumerate(zip(baseline['runs'], results['runs']), start=1):
+        for table, new in new_run['tables'].items():
+            old = old_run['tables'].get(table)
+            if old is None:
+                continue
+            parts = []
+            for phase in ['wall'] + PHASES:
+                old_seconds = old['wall_seconds'] if phase == 'wall' else old['phases'][phase]['seconds']
+                new_seconds = new['wall_seconds'] if phase == 'wall' else new['phases'][phase]['seconds']
+                change = f" ({(new_seconds - old_seconds) / old_seconds * 100:+.0f}%)" if old_seconds else ""
+                parts.append(f"{phase} {old_seconds:.2f} -> {new_seconds:.2f}{change}")
+            print(f"  Lauf {run} {table}: " + ", ".join(parts))
+
+# Funktion zum Einlesen der Kommandozeilenargumente
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark der Synchronisationen gegen lokale Ersatzdienste für Supabase und Google Drive."
+    )
+    parser.add_argument("--rows", type=int, default=1000, help="Zeilen pro Tabelle (Standard: 1000)")
+    parser.add_argument("--receipts", type=int, default=200, help="Zeilen mit Beleg pro Tabelle (Standard: 200)")
+    parser.add_argument("--keys", type=int, default=10,
+                        help="Anzahl Gruppierungsschlüssel (Karten, Mitarbeitende, Projekte; Standard: 10)")
+    parser.add_argument("--months", type=int, default=6, help="Zeitraum der Daten in Monaten (Standard: 6)")
+    parser.add_argument("--table", action="append", choices=TABLES,
+                        help="nur diese Tabelle messen (mehrfach möglich, Standard: alle)")
+    parser.add_argument("--supabase-latency-ms", type=float, default=20,
+                        help="Latenz pro Supabase-Anfrage in ms (Standard: 20)")
+    parser.add_argument("--drive-latency-ms", type=float, default=50,
+                        help="Latenz pro Drive-Aufruf in ms (Standard: 50)")
+    parser.add_argument("--image-size", default="600x800", help="Grösse der Beleg-Bilder in Pixeln (Standard: 600x800)")
+    parser.add_argument("--runs", type=int, default=2,
+                        help="Läufe nacheinander im selben Arbeitsverzeichnis; ab dem zweiten mit SYNC_FULL_REFRESH=1 "
+                             "ohne Änderungen (Standard: 2)")
+    parser.add_argument("--seed", type=int, default=1, help="Startwert für die synthetischen Daten")
+    parser.add_argument("--workdir", help="Arbeitsverzeichnis (Standard: temporäres Verzeichnis)")
+    parser.add_argument("--output", help="Ergebnisse als JSON in diese Datei schreiben")
+    parser.add_argument("--baseline", help="früheres JSON-Ergebnis zum Vergleich")
+    parser.add_argument("--verbose", action="store_true", help="Meldungen der Synchronisationen anzeigen (Stufe aus LOG_LEVEL, Standard INFO)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    from fake_supabase import FakeSupabase, make_tables
+    from fake_drive import FakeDrive
+
+    width, height = (int(value) for value in args.image_size.lower().split('x'))
+    tables = make_tables(args.rows, args.receipts, args.keys, args.months, args.seed)
+    supabase = FakeSupabase(tables, latency=args.supabase_latency_ms / 1000, image_size=(width, height))
+    os.environ['SUPABASE_URL'] = supabase.start()
+    os.environ.setdefault('API_KEY', 'benchmark')
+
+    # Meldungen der Synchronisationen nur mit --verbose (bzw. LOG_LEVEL), sonst nur Warnungen und Fehler
+    from sync_logging import setup_logging
+    setup_logging(None if args.verbose else "WARNING", stream=sys.stderr)
+
+    import sync_purchases
+    import sync_expenses
+    import sync_campaigns
+
+    jobs = {
+        'purchases': (sync_purchases, sync_purchases.sync_purchases),
+        'expenses': (sync_expenses, sync_expenses.sync_expenses),
+        'campaigns': (sync_campaigns, sync_campaigns.sync_campaigns),
+    }
+    selected = args.table or TABLES
+    instrumentation = None
+    drive = FakeDrive(latency=args.drive_latency_ms / 1000, tag=lambda: instrumentation.recorder.current())
+    instrumentation = Instrumentation(drive)
+    instrumentation.install([module for module, _ in jobs.values()])
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'rows': args.rows, 'receipts': args.receipts, 'keys': args.keys, 'months': args.months,
+            'tables': selected, 'supabase_latency_ms': args.supabase_latency_ms,
+            'drive_latency_ms': args.drive_latency_ms, 'image_size': args.image_size,
+            'runs': args.runs, 'seed': args.seed,
+        },
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+        },
+        'runs': [],
+    }
+
+    workdir_context = contextlib.nullcontext(args.workdir) if args.workdir else tempfile.TemporaryDirectory()
+    previous_dir = os.getcwd()
+    try:
+        with workdir_context as workdir:
+            os.makedirs(workdir, exist_ok=True)
+            os.chdir(workdir)
+            print(f"Benchmark in {workdir}: {args.rows} Zeilen, {args.receipts} Belege pro Tabelle", file=sys.stderr)
+            for run in range(1, args.runs + 1):
+                if run > 1:
+                    os.environ['SYNC_FULL_REFRESH'] = '1'
+                run_result = {'run': run, 'full_refresh': run > 1, 'tables': {}}
+                for table in selected:
+                    run_result['tables'][table] = run_table(table, jobs[table][1], instrumentation, supabase, drive)
+                    result = run_result['tables'][table]
+                    phases = ", ".join(f"{phase} {result['phases'][phase]['seconds']:.2f}" for phase in PHASES)
+                    print(f"Lauf {run} {table}: {result['wall_seconds']:.2f} s ({phases})"
+                          f"{'' if result['ok'] else ' FEHLER'}", file=sys.stderr)
+                results['runs'].append(run_result)
+    finally:
+        os.chdir(previous_dir)
+        supabase.stop()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Ergebnisse gespeichert: {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            print_comparison(json.load(f), results)
+    return 0 if all(result['ok'] for run in results['runs'] for result in run['tables'].values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+import os
+import json
+import logging
+import threading
+from run_metrics import timed
+
+logger = logging.getLogger(__name__)
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Drive nimmt höchstens 100 Aufrufe pro Batch-Request an
+BATCH_LIMIT = 100
+
+# Persistierter Index (parent_id, name) -> folder_id, wird zwischen den Läufen wiederverwendet
+FOLDER_INDEX_FILE = os.path.join('exports', 'drive_folders.json')
+
+# Gleichzeitige Synchronisationen im selben Prozess haben je einen eigenen FolderResolver, teilen
+# sich aber die Index-Datei: Speichern liest sie unter dieser Sperre neu und führt die Änderungen zusammen
+_index_lock = threading.Lock()
+# Index-Dateien, die mit DRIVE_FOLDER_REFRESH=1 in diesem Prozess bereits neu aufgebaut werden
+_refreshed_indexes = set()
+
+# Funktion zum Prüfen, ob Drive einen Aufruf mit 404 abgelehnt hat (Datei oder Ordner nicht gefunden)
+def is_not_found(error):
+    return getattr(getattr(error, 'resp', None), 'status', None) == 404
+
+# Ordner-Auflösung für Google Drive mit Cache nach (parent_id, Ordnername).
+# Bekannte Ordner kosten keinen API-Aufruf, nur neu benötigte Ordner werden abgefragt/erstellt.
+# Wurde ein Ordner aus dem Cache in Drive gelöscht (404), ersetzt refresh ihn durch einen neu
+# aufgelösten. Mit metrics werden die Drive-Aufrufe im Laufbericht erfasst.
+class FolderResolver:
+    def __init__(self, drive_service, index_file=None, metrics=None):
+        self.drive_service = drive_service
+        self.metrics = metrics
+        self.index_file = index_file or FOLDER_INDEX_FILE
+        self.root_id = None
+        self.folders = {}
+        self.created = set()
+        self.replaced = {}
+        # Stand des Index beim letzten Laden/Speichern (für das Zusammenführen beim Speichern)
+        self.saved = {}
+        self.discard_file = False
+        self.lock = threading.RLock()
+        self.listed = False
+        self.api_calls = 0
+        self.batch_requests = 0
+        self.load()
+
+    # Lade den Index von der Festplatte (falls vorhanden). Mit DRIVE_FOLDER_REFRESH=1 wird er nicht
+    # gelesen; der erste Resolver des Prozesses ersetzt die Datei beim Speichern, statt sie zu übernehmen.
+    def load(self):
+        if os.getenv("DRIVE_FOLDER_REFRESH", "").lower() in ("1", "true", "yes"):
+            with _index_lock:
+                if self.index_file not in _refreshed_indexes:
+                    _refreshed_indexes.add(self.index_file)
+                    self.discard_file = True
+            return
+        with _index_lock:
+            self.root_id, self.folders = self.read_index()
+        self.saved = dict(self.folders)
+
+    # Liest die Index-Datei; gibt (root_id, {(parent_id, name): folder_id}) zurück
+    def read_index(self):
+        if not os.path.exists(self.index_file):
+            return None, {}
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data.get('root_id'), {
+                (parent_id, name): folder_id for parent_id, name, folder_id in data.get('folders', [])
+            }
+        except Exception as e:
+            logger.warning("Fehler beim Lesen des Ordner-Index %s, baue ihn neu auf: %s", self.index_file, e)
+            return None, {}
+
+    # Speichere den Index atomar. Die Datei wird unter der Sperre neu gelesen und nur um die eigenen
+    # Änderungen seit dem letzten Laden/Speichern ergänzt (neue, geänderte und verworfene Einträge),
+    # damit gleichzeitige Synchronisationen ihre Ordner nicht gegenseitig überschreiben.
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_file) or '.', exist_ok=True)
+        with _index_lock:
+            if self.discard_file:
+                root_id, folders = None, {}
+                self.discard_file = False
+            else:
+                root_id, folders = self.read_index()
+            for key, folder_id in self.saved.items():
+                if key not in self.folders and folders.get(key) == folder_id:
+                    del folders[key]
+            folders.update({key: folder_id for key, folder_id in self.folders.items()
+                            if self.saved.get(key) != folder_id})
+            self.root_id = self.root_id or root_id
+            data = {
+                'root_id': self.root_id,
+                'folders': [[parent_id, name, folder_id] for (parent_id, name), folder_id in folders.items()]
+            }
+            tmp_file = f"{self.index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_file, self.index_file)
+            # Ordner der anderen Synchronisationen übernehmen
+            self.folders = folders
+            self.saved = dict(folders)
+
+    # ID des "Meine Ablage"-Stammordners (wird einmalig abgefragt und persistiert)
+    def root(self):
+        if self.root_id is None:
+            self.api_calls += 1
+            with timed(self.metrics, "drive_get_root"):
+                self.root_id = self.drive_service.files().get(fileId='root', fields='id').execute()['id']
+            self.save()
+        return self.root_id
+
+    # Wärme den Cache mit einer einzigen (seitenweisen) Auflistung aller Ordner vor und
+    # übernimmt die Teilbäume unterhalb der angegebenen Stammordner
+    def warm(self, root_names):
+        root_id = self.root()
+        if all((root_id, name) in self.folders for name in root_names):
+            return
+        children = {}
+        page_token = None
+        while True:
+            self.api_calls += 1
+            with timed(self.metrics, "drive_list_folders"):
+                response = self.drive_service.files().list(
+                    q=f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false",
+                    spaces='drive',
+                    fields='nextPageToken, files(id, name, parents)',
+                    pageSize=1000,
+                    pageToken=page_token
+                ).execute()
+            for folder in response.get('files', []):
+                for parent_id in folder.get('parents', []):
+                    children.setdefault(parent_id, []).append(folder)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        pending = [folder for folder in children.get(root_id, []) if folder['name'] in root_names]
+        for folder in pending:
+            self.folders.setdefault((root_id, folder['name']), folder['id'])
+        while pending:
+            parent = pending.pop()
+            for folder in children.get(parent['id'], []):
+                self.folders.setdefault((parent['id'], folder['name']), folder['id'])
+                pending.append(folder)
+        # Nach der vollständigen Auflistung ist der Cache für diese Teilbäume massgebend
+        self.listed = True
+        self.save()
+
+    # Aktuelle ID eines Ordners (nach refresh die ID des Ersatzordners)
+    def current(self, folder_id):
+        return self.replaced.get(folder_id, folder_id)
+
+    # Pfad eines Ordners ab dem Stammordner aus dem Cache, None wenn er nicht darin vorkommt
+    def path_of(self, folder_id):
+        parents = {child_id: key for key, child_id in self.folders.items()}
+        path = []
+        while folder_id != self.root_id:
+            if folder_id not in parents:
+                return None
+            folder_id, name = parents[folder_id]
+            path.insert(0, name)
+        return tuple(path)
+
+    # Verwirft einen Ordner und alle Einträge darunter aus dem Cache
+    def invalidate(self, folder_id):
+        stale = {folder_id}
+        while True:
+            keys = [key for key, child_id in self.folders.items() if child_id in stale or key[0] in stale]
+            if not keys:
+                break
+            for key in keys:
+                stale.add(self.folders.pop(key))
+        self.save()
+
+    # Funktion zum Ersetzen eines Ordners aus dem Cache, den Drive nicht mehr kennt (404, z. B. von Hand
+    # gelöscht): Eintrag und Teilbaum verwerfen, Pfad neu suchen bzw. anlegen. Gibt die neue ID zurück,
+    # None wenn der Ordner nicht aus dem Cache stammt. Mehrere Threads erhalten denselben Ersatz.
+    def refresh(self, folder_id):
+        with self.lock:
+            if folder_id in self.replaced:
+                return self.replaced[folder_id]
+            path = self.path_of(folder_id)
+            if not path:
+                return None
+            logger.warning("Ordner %s (%s) nicht mehr in Google Drive vorhanden, löse ihn neu auf.",
+                           '/'.join(path), folder_id)
+            self.invalidate(folder_id)
+            # Der Cache ist nicht mehr massgebend, vorhandene Ordner zuerst suchen
+            self.listed = False
+            new_id = self.ensure_paths([path])[path]
+            self.replaced[folder_id] = new_id
+            return new_id
+
+    # Funktion zum Erstellen oder Finden eines Ordners (ohne parent_id im Stammordner).
+    # Meldet Drive den Elternordner aus dem Cache als gelöscht, wird er ersetzt und einmal wiederholt.
+    def get_or_create(self, folder_name, parent_id=None, retry=True):
+        parent_id = self.current(parent_id or self.root())
+        key = (parent_id, folder_name)
+        if key in self.folders:
+            return self.folders[key]
+        try:
+            return self._get_or_create(folder_name, parent_id)
+        except Exception as e:
+            if retry and is_not_found(e) and self.refresh(parent_id) not in (None, parent_id):
+                return self.get_or_create(folder_name, parent_id, retry=False)
+            raise
+
+    def _get_or_create(self, folder_name, parent_id):
+        key = (parent_id, folder_name)
+        query = (
+            f"name='{folder_name}' and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+            f" and '{parent_id}' in parents"
+        )
+        self.api_calls += 1
+        with timed(self.metrics, "drive_get_or_create_folder"):
+            response = self.drive_service.files().list(q=query, spaces='drive', fields='files(id)').execute()
+            folders = response.get('files', [])
+            if folders:
+                folder_id = folders[0]['id']
+            else:
+                file_metadata = {
+                    'name': folder_name,
+                    'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [parent_id]
+                }
+                self.api_calls += 1
+                folder_id = self.drive_service.files().create(body=file_metadata, fields='id').execute().get('id')
+                self.created.add(folder_id)
+        self.folders[key] = folder_id
+        self.save()
+        return folder_id
+
+    # Funktion zum Ausführen von Drive-Aufrufen in Batch-Requests (je höchstens BATCH_LIMIT).
+    # requests ist eine Liste (key, request); gibt {key: Antwort} und {key: Fehler} zurück.
+    def execute_batch(self, requests):
+        results = {}
+        errors = {}
+        for start in range(0, len(requests), BATCH_LIMIT):
+            chunk = requests[start:start + BATCH_LIMIT]
+            errors_before = len(errors)
+
+            def callback(request_id, response, exception, chunk=chunk):
+                key = chunk[int(request_id)][0]
+                if exception is not None:
+                    errors[key] = exception
+                else:
+                    results[key] = response
+
+            batch = self.drive_service.new_batch_http_request(callback=callback)
+            for index, (_, request) in enumerate(chunk):
+                batch.add(request, request_id=str(index))
+            self.api_calls += len(chunk)
+            self.batch_requests += 1
+            with timed(self.metrics, "drive_folder_batch") as timer:
+                batch.execute()
+                timer.error = len(errors) > errors_before
+        return results, errors
+
+    # Funktion zum Auflösen vieler Ordnerpfade (Tupel von Ordnernamen ab dem Stammordner) auf einmal.
+    # Fehlende Ordner werden Ebene für Ebene gesucht und per Batch-Request erstellt;
+    # gibt {Pfad: folder_id} zurück, danach beantwortet get_or_create alles aus dem Cache.
+    def ensure_paths(self, paths):
+        paths = {tuple(path) for path in paths}
+        resolved = {(): self.root()}
+        depth = max((len(path) for path in paths), default=0)
+        for level in range(1, depth + 1):
+            missing = []
+            for prefix in sorted({path[:level] for path in paths if len(path) >= level}):
+                key = (resolved[prefix[:-1]], prefix[-1])
+                if key in self.folders:
+                    resolved[prefix] = self.folders[key]
+                else:
+                    missing.append(prefix)
+            if not missing:
+                continue
+
+            # Nur suchen, wenn der Cache nicht massgebend ist und der Elternordner nicht neu ist
+            lookup = [
+                prefix for prefix in missing
+                if not self.listed and resolved[prefix[:-1]] not in self.created
+            ]
+            found, errors = self.execute_batch([
+                (prefix, self.drive_service.files().list(
+                    q=(f"name='{prefix[-1]}' and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+                       f" and '{resolved[prefix[:-1]]}' in parents"),
+                    spaces='drive',
+                    fields='files(id)'
+                ))
+                for prefix in lookup
+            ])
+            to_create = []
+            for prefix in missing:
+                folders = found.get(prefix, {}).get('files', [])
+                if folders:
+                    resolved[prefix] = folders[0]['id']
+                elif prefix not in errors:
+                    to_create.append(prefix)
+
+            created, create_errors = self.execute_batch([
+                (prefix, self.drive_service.files().create(
+                    body={'name': prefix[-1], 'mimeType': FOLDER_MIME_TYPE, 'parents': [resolved[prefix[:-1]]]},
+                    fields='id'
+                ))
+                for prefix in to_create
+            ])
+            for prefix, folder in created.items():
+                resolved[prefix] = folder['id']
+                self.created.add(folder['id'])
+            for prefix in missing:
+                if prefix in resolved:
+                    self.folders[(resolved[prefix[:-1]], prefix[-1])] = resolved[prefix]
+
+            # Fehlgeschlagene Batch-Aufrufe einzeln wiederholen
+            for prefix in missing:
+                if prefix not in resolved:
+                    error = errors.get(prefix) or create_errors.get(prefix)
+                    logger.warning("Batch-Aufruf für Ordner %s fehlgeschlagen, versuche einzeln: %s", '/'.join(prefix), error)
+                    resolved[prefix] = self.get_or_create(prefix[-1], resolved[prefix[:-1]])
+            self.save()
+        return {path: resolved[path] for path in paths}
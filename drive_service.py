@@ -0,0 +1,59 @@
+import os
+import pickle
+import threading
+
+# Google Drive API-Einstellungen
+SCOPES = ['https://www.googleapis.com/auth/drive']
+CREDENTIALS_FILE = 'credentials.json'
+TOKEN_FILE = 'token.pickle'
+
+# Bisherige Token der einzelnen Skripte, werden beim ersten Start übernommen
+LEGACY_TOKEN_FILES = ['token_purchases.pickle', 'token_expenses.pickle', 'token_campaigns.pickle']
+
+# Eine OAuth-Sitzung pro Prozess, gemeinsam genutzt von allen Synchronisationen
+_lock = threading.Lock()
+_credentials = None
+_service = None
+
+# Funktion zum Laden (bzw. Erneuern oder erstmaligen Anfordern) der OAuth-Anmeldedaten
+def get_credentials():
+    from google.auth.transport.requests import Request
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    global _credentials
+    with _lock:
+        creds = _credentials
+        token_path = os.getenv("GOOGLE_TOKEN_FILE", TOKEN_FILE)
+        if creds is None:
+            for token_file in [token_path] + LEGACY_TOKEN_FILES:
+                if os.path.exists(token_file):
+                    with open(token_file, 'rb') as token:
+                        creds = pickle.load(token)
+                    break
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+                creds = flow.run_local_server(port=0)
+            with open(token_path, 'wb') as token:
+                pickle.dump(creds, token)
+        _credentials = creds
+        return creds
+
+# Funktion zum Erstellen eines neuen Drive-Dienstes (für weitere Threads, httplib2 ist nicht thread-sicher)
+def build_drive_service():
+    from googleapiclient.discovery import build
+
+    return build('drive', 'v3', credentials=get_credentials())
+
+# Funktion zum Einrichten des gemeinsamen Google Drive-Dienstes
+def get_drive_service():
+    from googleapiclient.discovery import build
+
+    global _service
+    credentials = get_credentials()
+    with _lock:
+        if _service is None:
+            _service = build('drive', 'v3', credentials=credentials)
+        return _service
@@ -0,0 +1,246 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from sync_state import get_upload_session, set_upload_session, delete_upload_session
+from drive_folders import is_not_found
+from run_metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Resumable Uploads: Dateien ab DRIVE_RESUMABLE_MIN_MB werden in Blöcken zu DRIVE_UPLOAD_CHUNK_MB
+# übertragen (Vielfaches von 256 KB). Die Sitzungs-URI wird im Zustandsspeicher abgelegt, damit ein
+# abgebrochener Lauf den Upload beim nächsten Start an der bestätigten Position fortsetzt.
+CHUNK_ALIGNMENT = 256 * 1024
+
+# Funktion zum Berechnen der MD5-Prüfsumme einer lokalen Datei (Vergleich mit md5Checksum in Drive)
+def file_md5(file_path):
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Uploads nach Google Drive mit einer Auflistung pro Zielordner statt einer Abfrage pro Datei.
+# Upload-Modus (DRIVE_UPLOAD_MODE): "update" ersetzt den Inhalt vorhandener Dateien, wenn die
+# MD5-Prüfsumme abweicht, "skip" überspringt vorhandene Dateien wie bisher.
+# Der Drive-Dienst (httplib2) ist nicht thread-sicher; mit service_factory erhält
+# jeder weitere Thread einen eigenen Dienst. Ohne metrics werden die Messwerte des Ordner-Caches übernommen.
+class DriveUploader:
+    def __init__(self, drive_service, folders=None, service_factory=None, metrics=None):
+        self.drive_service = drive_service
+        self.folders = folders
+        self.service_factory = service_factory
+        self.metrics = metrics if metrics is not None else getattr(folders, 'metrics', None)
+        self.owner_thread = threading.current_thread()
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.listings = {}
+        self.mode = os.getenv("DRIVE_UPLOAD_MODE", "update").lower()
+        chunk_bytes = int(float(os.getenv("DRIVE_UPLOAD_CHUNK_MB", 8)) * 1024 * 1024)
+        self.chunk_size = max(CHUNK_ALIGNMENT, chunk_bytes // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+        self.resumable_min_bytes = int(float(os.getenv("DRIVE_RESUMABLE_MIN_MB", 5)) * 1024 * 1024)
+        self.retries = int(os.getenv("DRIVE_UPLOAD_RETRIES", 3))
+        self.api_calls = 0
+        self.uploaded_count = 0
+
+    # Drive-Dienst für den aktuellen Thread
+    def service(self):
+        if self.service_factory is None or threading.current_thread() is self.owner_thread:
+            return self.drive_service
+        if not hasattr(self.local, 'service'):
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    # Aktuelle ID eines Zielordners (ersetzt, falls der Ordner aus dem Cache in Drive gelöscht wurde)
+    def target(self, folder_id):
+        return self.folders.current(folder_id) if self.folders is not None else folder_id
+
+    # Funktion zum Ersetzen eines Zielordners nach einem 404 (Ordner oder Datei in Drive gelöscht).
+    # Gibt True zurück, wenn der Aufruf wiederholt werden kann.
+    def refresh_folder(self, error, folder_id):
+        if self.folders is None or not is_not_found(error):
+            return False
+        with self.lock:
+            self.listings.pop(folder_id, None)
+        return self.folders.refresh(folder_id) is not None
+
+    # Alle Dateien eines Ordners (Name -> Datei-Metadaten), einmal pro Ordner seitenweise geladen.
+    # Die Sperre schützt nur den Cache; die Auflistung selbst läuft ohne Sperre, damit mehrere
+    # Threads verschiedene Ordner gleichzeitig auflisten können.
+    def folder_files(self, folder_id, retry=True):
+        folder_id = self.target(folder_id)
+        with self.lock:
+            if folder_id in self.listings:
+                return self.listings[folder_id]
+            # In diesem Lauf neu erstellte Ordner sind leer und müssen nicht aufgelistet werden
+            if self.folders is not None and folder_id in self.folders.created:
+                return self.listings.setdefault(folder_id, {})
+        try:
+            files = self.list_folder(folder_id)
+        except Exception as e:
+            if retry and self.refresh_folder(e, folder_id):
+                return self.folder_files(folder_id, retry=False)
+            raise
+        with self.lock:
+            # Hat ein anderer Thread den Ordner inzwischen aufgelistet, gilt dessen (evtl. ergänzter) Eintrag
+            return self.listings.setdefault(folder_id, files)
+
+    # Listet die Dateien eines Ordners seitenweise auf (ohne Cache)
+    def list_folder(self, folder_id):
+        files = {}
+        page_token = None
+        while True:
+            with self.lock:
+                self.api_calls += 1
+            with timed(self.metrics, "drive_list_files"):
+                response = self.service().files().list(
+                    q=f"'{folder_id}' in parents and trashed=false",
+                    spaces='drive',
+                    fields='nextPageToken, files(id, name, md5Checksum)',
+                    pageSize=1000,
+                    pageToken=page_token
+                ).execute()
+            for file in response.get('files', []):
+                files.setdefault(file['name'], file)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return files
+
+    # Funktion zum Prüfen, ob eine Datei im Ordner existiert (aus der Ordner-Auflistung)
+    def exists(self, file_name, folder_id):
+        return file_name in self.folder_files(folder_id)
+
+    # Entscheidet vor dem Übertragen von Bytes, ob eine Datei neu ("create"), geändert ("update")
+    # oder unverändert (None) ist
+    def plan(self, file_path, file_name, folder_id):
+        file = self.folder_files(folder_id).get(file_name)
+        if file is None:
+            return "create"
+        if self.mode == "update" and file.get('md5Checksum') != file_md5(file_path):
+            return "update"
+        return None
+
+    # Funktion zum Übertragen einer Datei; make_request(media) erzeugt den create/update-Aufruf.
+    # Kleine Dateien gehen in einem Request hoch, grosse resumable in Blöcken mit Fortschrittsanzeige.
+    def send(self, file_path, file_name, target, make_request):
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
+
+        size = os.path.getsize(file_path)
+        started = time.monotonic()
+        with timed(self.metrics, "drive_upload") as timer:
+            timer.bytes = size
+            if size < self.resumable_min_bytes:
+                file = make_request(MediaFileUpload(file_path)).execute(num_retries=self.retries)
+            else:
+                session_key = f"{target}:{file_md5(file_path)}"
+                try:
+                    file = self.send_resumable(file_path, file_name, size, session_key, make_request, resume=True)
+                except HttpError as e:
+                    # Abgelaufene oder unbekannte Sitzung: verwerfen und neu beginnen
+                    if e.resp.status not in (404, 410):
+                        raise
+                    delete_upload_session(session_key)
+                    logger.warning("Upload-Sitzung für %s abgelaufen, beginne neu.", file_name)
+                    file = self.send_resumable(file_path, file_name, size, session_key, make_request, resume=False)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.debug("Übertragen: %s (%.1f MB in %.1f s, %.2f MB/s)",
+                     file_name, size / 1024 / 1024, elapsed, size / 1024 / 1024 / elapsed)
+        return file
+
+    def send_resumable(self, file_path, file_name, size, session_key, make_request, resume):
+        from googleapiclient.http import MediaFileUpload
+
+        media = MediaFileUpload(file_path, chunksize=self.chunk_size, resumable=True)
+        request = make_request(media)
+        resumable_uri = get_upload_session(session_key) if resume else None
+        if resumable_uri:
+            # googleapiclient bietet keine öffentliche Schnittstelle zum Fortsetzen einer Sitzung aus
+            # einem früheren Prozess. Mit gesetzter resumable_uri und dem (privaten) Fehlerzustand
+            # fragt next_chunk zuerst per leerem PUT ("Content-Range: bytes */Grösse") die bei Drive
+            # bestätigte Position ab und sendet ab dort weiter. Ohne den Fehlerzustand würde der erste
+            # Block ab Position 0 gesendet. Das Verhalten ist in google-api-python-client 2.x stabil,
+            # deshalb ist die Version in requirements.txt auf <3 begrenzt.
+            request.resumable_uri = resumable_uri
+            request._in_error_state = True
+            logger.info("Setze unterbrochenen Upload fort: %s", file_name)
+        response = None
+        while response is None:
+            status, response = request.next_chunk(num_retries=self.retries)
+            if resumable_uri is None and request.resumable_uri:
+                resumable_uri = request.resumable_uri
+                set_upload_session(session_key, resumable_uri)
+            if status is not None:
+                logger.debug("Upload %s: %d%% (%.1f von %.1f MB)", file_name, int(status.progress() * 100),
+                             status.resumable_progress / 1024 / 1024, size / 1024 / 1024)
+        delete_upload_session(session_key)
+        return response
+
+    # Funktion zum Hochladen einer Datei ohne Existenzprüfung. Meldet Drive den Zielordner als
+    # gelöscht (404), wird er ersetzt und der Upload einmal wiederholt.
+    def create(self, file_path, file_name, folder_id, retry=True):
+        folder_id = self.target(folder_id)
+        try:
+            file_metadata = {
+                'name': file_name,
+                'parents': [folder_id]
+            }
+            file = self.send(
+                file_path, file_name, f"create:{folder_id}/{file_name}",
+                lambda media: self.service().files().create(body=file_metadata, media_body=media,
+                                                            fields='id, name, md5Checksum')
+            )
+            files = self.folder_files(folder_id)
+            with self.lock:
+                self.api_calls += 1
+                self.uploaded_count += 1
+                files[file_name] = file
+            logger.debug("Datei erfolgreich hochgeladen nach Google Drive: %s (ID: %s)", file_name, file.get('id'))
+            return True
+        except Exception as e:
+            if retry and self.refresh_folder(e, folder_id):
+                return self.create(file_path, file_name, folder_id, retry=False)
+            logger.error("Fehler beim Hochladen der Datei %s nach Google Drive: %s", file_name, e)
+            return False
+
+    # Funktion zum Ersetzen des Inhalts einer vorhandenen Datei (gleiche Datei-ID in Drive).
+    # Ist die Datei oder ihr Ordner in Drive gelöscht (404), wird sie stattdessen neu hochgeladen.
+    def update(self, file_path, file_name, folder_id):
+        folder_id = self.target(folder_id)
+        try:
+            file_id = self.folder_files(folder_id)[file_name]['id']
+            file = self.send(
+                file_path, file_name, f"update:{file_id}",
+                lambda media: self.service().files().update(fileId=file_id, media_body=media,
+                                                            fields='id, name, md5Checksum')
+            )
+            files = self.folder_files(folder_id)
+            with self.lock:
+                self.api_calls += 1
+                self.uploaded_count += 1
+                files[file_name] = file
+            logger.debug("Datei in Google Drive aktualisiert: %s (ID: %s)", file_name, file.get('id'))
+            return True
+        except Exception as e:
+            if self.refresh_folder(e, folder_id):
+                return self.create(file_path, file_name, folder_id, retry=False)
+            logger.error("Fehler beim Aktualisieren der Datei %s in Google Drive: %s", file_name, e)
+            return False
+
+    # Funktion zum Hochladen einer Datei nach Google Drive (unveränderte Dateien werden übersprungen);
+    # gibt False zurück, wenn der Upload fehlschlug
+    def upload(self, file_path, file_name, folder_id):
+        action = self.plan(file_path, file_name, folder_id)
+        if action == "create":
+            return self.create(file_path, file_name, folder_id)
+        if action == "update":
+            return self.update(file_path, file_name, folder_id)
+        if self.metrics is not None:
+            self.metrics.count("drive_upload_skipped")
+        if self.mode == "update":
+            logger.debug("Datei %s ist in Google Drive unverändert, überspringe Upload.", file_name)
+        else:
+            logger.debug("Datei %s existiert bereits in Google Drive, überspringe Upload.", file_name)
+        return True
@@ -0,0 +1,137 @@
+import os
+import shutil
+import logging
+import sqlite3
+import hashlib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Inhaltsadressierter Cache für umgewandelte Beleg-PDFs.
+# Index: Storage-Pfad -> (ETag, Last-Modified, SHA-256 des PDFs), Dateien unter objects/<sha256>.pdf.
+RECEIPT_CACHE_DIR = os.path.join('exports', '.receipt_cache')
+DEFAULT_MAX_MB = 1024
+
+# Funktion zum Prüfen, ob der Beleg-Cache aktiviert ist (RECEIPT_CACHE=0 schaltet ihn ab)
+def receipt_cache_enabled():
+    return os.getenv("RECEIPT_CACHE", "1").lower() not in ("0", "false", "no")
+
+# Funktion zum Ermitteln der Validatoren (ETag, Last-Modified) aus den Antwort-Headern
+def response_validators(headers):
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified')
+    }
+
+class ReceiptCache:
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.getenv("RECEIPT_CACHE_DIR", RECEIPT_CACHE_DIR)
+        self.objects_dir = os.path.join(self.cache_dir, 'objects')
+        self.max_bytes = max_bytes or int(float(os.getenv("RECEIPT_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " storage_path TEXT PRIMARY KEY,"
+                " etag TEXT,"
+                " last_modified TEXT,"
+                " sha256 TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+        self.hits = 0
+        self.misses = 0
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, f"{sha256}.pdf")
+
+    def _entry(self, storage_path):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, sha256, size FROM entries WHERE storage_path = ?",
+                (storage_path,)
+            ).fetchone()
+        if row and os.path.exists(self.object_path(row[2])):
+            return row
+        return None
+
+    # Header für einen bedingten GET (If-None-Match / If-Modified-Since)
+    def conditional_headers(self, storage_path):
+        entry = self._entry(storage_path)
+        if not entry:
+            return {}
+        etag, last_modified, _, _ = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    # Stellt das PDF nach einer 304-Antwort aus dem Cache wieder her; gibt False zurück,
+    # wenn der Eintrag fehlt (dann muss ohne Bedingung neu geladen werden)
+    def restore(self, storage_path, local_pdf_path):
+        entry = self._entry(storage_path)
+        if not entry:
+            return False
+        _, _, sha256, size = entry
+        if not (os.path.exists(local_pdf_path) and os.path.getsize(local_pdf_path) == size):
+            shutil.copyfile(self.object_path(sha256), local_pdf_path)
+        with self.lock:
+            self.hits += 1
+            with self.conn:
+                self.conn.execute("UPDATE entries SET last_used = ? WHERE storage_path = ?",
+                                  (time.time(), storage_path))
+        return True
+
+    # Legt ein umgewandeltes PDF (Bytes oder bereits geschriebene Datei) im Cache ab
+    def store(self, storage_path, validators, pdf_bytes=None, pdf_path=None):
+        if not validators or not (validators.get('etag') or validators.get('last_modified')):
+            return
+        if pdf_bytes is None:
+            with open(pdf_path, 'rb') as f:
+                pdf_bytes = f.read()
+        sha256 = hashlib.sha256(pdf_bytes).hexdigest()
+        object_path = self.object_path(sha256)
+        if not os.path.exists(object_path):
+            part_path = f"{object_path}.{threading.get_ident()}.part"
+            with open(part_path, 'wb') as f:
+                f.write(pdf_bytes)
+            os.replace(part_path, object_path)
+        with self.lock:
+            self.misses += 1
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (storage_path, etag, last_modified, sha256, size, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (storage_path, validators.get('etag'), validators.get('last_modified'),
+                     sha256, len(pdf_bytes), time.time())
+                )
+
+    # Entfernt die am längsten nicht verwendeten PDFs, bis der Cache unter max_bytes liegt
+    def evict(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT sha256, MAX(size), MAX(last_used) FROM entries GROUP BY sha256 ORDER BY MAX(last_used)"
+            ).fetchall()
+            total = sum(size for _, size, _ in rows)
+            evicted = 0
+            for sha256, size, _ in rows:
+                if total <= self.max_bytes:
+                    break
+                object_path = self.object_path(sha256)
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+                with self.conn:
+                    self.conn.execute("DELETE FROM entries WHERE sha256 = ?", (sha256,))
+                total -= size
+                evicted += 1
+        if evicted:
+            logger.info("Beleg-Cache: %d PDFs entfernt (LRU), Grösse jetzt %.1f MB", evicted, total / 1024 / 1024)
+        return evicted
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,333 @@
+import io
+import os
+import queue
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from supabase_client import supabase_get
+from async_downloads import async_engine_available, download_jobs
+from receipt_cache import ReceiptCache, receipt_cache_enabled, response_validators
+from run_metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Ein Beleg-Auftrag ist ein Tupel (storage_path, local_pdf_path, file_name, folder_id, bucket);
+# bucket ist die Gruppe (Schlüssel, month_year) der Zeile für die Zusammenfassung.
+ReceiptJob = namedtuple('ReceiptJob', ['storage_path', 'local_pdf_path', 'file_name', 'folder_id', 'bucket'])
+
+# Funktion zum Erstellen der Aufträge aus gleich langen Spalten (vorab vektorisiert berechnet)
+def make_jobs(storage_paths, local_pdf_paths, file_names, folder_ids, keys, month_years):
+    buckets = zip(keys, month_years)
+    return list(map(ReceiptJob._make, zip(storage_paths, local_pdf_paths, file_names, folder_ids, buckets)))
+
+# Funktion zum Auswählen der Zeilen mit gesetztem Storage-Pfad
+def has_path(column):
+    return column.notna() & (column.astype(str) != '')
+
+# Funktion zum Zuordnen der Fehler der Pipeline zu den Zeilen (ID -> Meldung); mehrere Zeilen
+# können denselben Zielpfad haben
+def failed_rows(errors, local_pdf_paths, row_ids):
+    ids_by_path = {}
+    for local_pdf_path, row_id in zip(local_pdf_paths, row_ids):
+        ids_by_path.setdefault(local_pdf_path, []).append(row_id)
+    return {
+        row_id: f"{stage}: {message}"
+        for job, stage, message in errors
+        for row_id in ids_by_path.get(job[1], [])
+    }
+
+# Markiert das Ende einer Warteschlange
+_DONE = object()
+# Markiert in der Upload-Warteschlange eine vorab zu ladende Ordner-Auflistung (_LIST, folder_id)
+_LIST = object()
+
+# Funktion zum Lesen einer Worker-Anzahl aus der Umgebung
+def worker_count(env_name, default):
+    return max(0, int(os.getenv(env_name, default)))
+
+# Funktion zum Herunterladen eines Objekts aus dem Supabase Storage.
+# Gibt (content, validators) zurück: content enthält die Bild-Bytes zur Umwandlung oder ist
+# None, wenn das PDF bereits fertig liegt (direkt geladenes PDF oder unverändert aus dem Cache).
+def download_object(storage_path, local_pdf_path, label="Beleg", cache=None, metrics=None):
+    logger.debug("Versuche, %s herunterzuladen von: %s", label, storage_path)
+    path = f"/storage/v1/object/{storage_path}"
+    headers = cache.conditional_headers(storage_path) if cache is not None else {}
+    with timed(metrics, "receipt_download") as timer:
+        response = supabase_get(path, headers=headers)
+        restored = response.status_code == 304 and cache.restore(storage_path, local_pdf_path)
+        if response.status_code == 304 and not restored:
+            response = supabase_get(path)
+        timer.bytes = len(response.content)
+        timer.error = response.status_code not in (200, 304)
+    if restored:
+        if metrics is not None:
+            metrics.count("receipt_not_modified")
+        logger.debug("%s unverändert, aus dem Cache übernommen: %s", label, local_pdf_path)
+        return None, None
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} - {response.text}")
+    validators = response_validators(response.headers)
+    # Prüfe, ob die Datei bereits ein PDF ist
+    if storage_path.lower().endswith('.pdf'):
+        with open(local_pdf_path, 'wb') as f:
+            f.write(response.content)
+        if cache is not None:
+            cache.store(storage_path, validators, pdf_bytes=response.content)
+        logger.debug("PDF-%s heruntergeladen: %s", label, local_pdf_path)
+        return None, None
+    logger.debug("Bild heruntergeladen: %s (%d Bytes)", storage_path, len(response.content))
+    return response.content, validators
+
+# Funktion zum Aufbereiten von Bildern, die img2pdf nicht direkt einbetten kann
+# (HEIC vom iPhone, Transparenz). Jede Seite/jedes Frame wird verlustfrei als PNG übergeben.
+def normalize_image(content):
+    from PIL import Image, ImageSequence
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    except ImportError:
+        pass
+
+    pages = []
+    with Image.open(io.BytesIO(content)) as image:
+        for frame in ImageSequence.Iterator(image):
+            frame = frame.copy()
+            if frame.mode in ('RGBA', 'LA') or (frame.mode == 'P' and 'transparency' in frame.info):
+                rgba = frame.convert('RGBA')
+                background = Image.new('RGB', rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                frame = background
+            elif frame.mode not in ('RGB', 'L', '1'):
+                frame = frame.convert('RGB')
+            buffer = io.BytesIO()
+            frame.save(buffer, format='PNG')
+            pages.append(buffer.getvalue())
+    return pages
+
+# Optionen für img2pdf, damit dasselbe Bild immer byte-identische PDFs ergibt: ohne
+# /CreationDate und /ModDate und mit der eingebauten Engine (die pikepdf-Engine schreibt je nach
+# Version eine zufällige /ID). Sonst würde jede erneute Umwandlung (leerer Cache, RECEIPT_CACHE=0,
+# --since/--month) über die MD5-Prüfung einen unveränderten Beleg erneut hochladen.
+def deterministic_options(img2pdf):
+    options = {'nodate': True}
+    engine = getattr(img2pdf, 'Engine', None)
+    if engine is not None:
+        options['engine'] = engine.internal
+    return options
+
+# Funktion zum Umwandeln von Bild-Bytes in PDF-Bytes ohne temporäre Dateien.
+# JPEG, PNG und mehrseitige TIFFs gehen unverändert an img2pdf, alles andere wird vorher über
+# Pillow aufbereitet. Das Ergebnis ist für dasselbe Bild byte-identisch.
+def image_to_pdf(content):
+    import img2pdf
+
+    options = deterministic_options(img2pdf)
+    try:
+        return img2pdf.convert(content, **options)
+    except (img2pdf.ImageOpenError, img2pdf.AlphaChannelError, img2pdf.UnsupportedColorspaceError):
+        return img2pdf.convert(normalize_image(content), **options)
+
+# Funktion zum Umwandeln eines Bildes in ein PDF (läuft im Prozess-Pool)
+def convert_image(content):
+    return image_to_pdf(content)
+
+# Nebenläufige Verarbeitung der Belege: Download (Threads) -> Umwandlung in PDF
+# (Prozesse) -> Upload nach Google Drive (Threads). Die Stufen sind über begrenzte
+# Warteschlangen verbunden, Fehler werden pro Zeile gemeldet. Ohne metrics werden die
+# Messwerte des Uploaders übernommen.
+class ReceiptPipeline:
+    def __init__(self, uploader, label="Beleg", download_workers=None, convert_workers=None,
+                 upload_workers=None, queue_size=None, metrics=None):
+        self.uploader = uploader
+        self.label = label
+        self.metrics = metrics if metrics is not None else getattr(uploader, 'metrics', None)
+        self.download_workers = download_workers or worker_count("RECEIPT_DOWNLOAD_WORKERS", 8)
+        self.convert_workers = convert_workers if convert_workers is not None else worker_count(
+            "RECEIPT_CONVERT_WORKERS", os.cpu_count() or 1)
+        self.upload_workers = upload_workers or worker_count("DRIVE_UPLOAD_WORKERS", 4)
+        self.queue_size = queue_size or worker_count("PIPELINE_QUEUE_SIZE", 32)
+        # Download-Engine: "sync" (Threads mit requests) oder "async" (asyncio/httpx)
+        self.engine = os.getenv("RECEIPT_DOWNLOAD_ENGINE", "sync").lower()
+        if self.engine == "async" and not async_engine_available():
+            logger.warning("httpx ist nicht installiert, verwende die synchrone Download-Engine.")
+            self.engine = "sync"
+        self.async_concurrency = worker_count("RECEIPT_ASYNC_CONCURRENCY", 32)
+        self.cache = None
+        self.errors = []
+        self.bucket_counts = {}
+        self.lock = threading.Lock()
+
+    # Zählt ein Ergebnis für die Zusammenfassung pro Gruppe (Schlüssel, month_year)
+    def tally(self, job, outcome):
+        with self.lock:
+            counts = self.bucket_counts.setdefault(job[4], {'ok': 0, 'converted': 0, 'errors': 0})
+            counts[outcome] += 1
+
+    # Merke einen Fehler für eine Zeile und gib ihn aus
+    def report_error(self, job, stage, error):
+        storage_path, _, file_name, _, _ = job
+        logger.error("Fehler beim %s des %ss %s (%s): %s", stage, self.label, storage_path, file_name, error)
+        with self.lock:
+            self.errors.append((job, stage, str(error)))
+        self.tally(job, 'errors')
+
+    # Gibt pro Gruppe eine Zeile aus statt einer pro Beleg (die Einzelmeldungen gibt es mit LOG_LEVEL=DEBUG)
+    def log_summary(self):
+        totals = {'ok': 0, 'converted': 0, 'errors': 0}
+        for (key, month_year), counts in sorted(self.bucket_counts.items(), key=lambda item: tuple(map(str, item[0]))):
+            bucket = f"{key} {month_year}"
+            logger.info("%s: %d verarbeitet, davon %d neu umgewandelt, %d Fehler",
+                        bucket, counts['ok'], counts['converted'], counts['errors'],
+                        extra={'bucket': bucket, 'processed': counts['ok'], 'converted': counts['converted'],
+                               'errors': counts['errors']})
+            for outcome, count in counts.items():
+                totals[outcome] += count
+        logger.info("%s-Aufträge: %d verarbeitet, davon %d neu umgewandelt, %d Fehler",
+                    self.label, totals['ok'], totals['converted'], totals['errors'])
+
+    def _download_stage(self, in_queue, convert_queue, upload_queue):
+        while True:
+            job = in_queue.get()
+            if job is _DONE:
+                return
+            storage_path, local_pdf_path, _, _, _ = job
+            try:
+                content, validators = download_object(storage_path, local_pdf_path, self.label, self.cache,
+                                                      self.metrics)
+                if content is None:
+                    upload_queue.put(job)
+                else:
+                    convert_queue.put((job, content, validators))
+            except Exception as e:
+                self.report_error(job, "Herunterladen", e)
+
+    def _async_download_stage(self, jobs, convert_queue, upload_queue):
+        finished = set()
+
+        def on_result(job, content, validators, error):
+            finished.add(job[1])
+            if error is not None:
+                self.report_error(job, "Herunterladen", error)
+            elif content is not None:
+                logger.debug("Bild heruntergeladen: %s (%d Bytes)", job[0], len(content))
+                convert_queue.put((job, content, validators))
+            else:
+                logger.debug("PDF-%s bereit: %s", self.label, job[1])
+                upload_queue.put(job)
+
+        try:
+            download_jobs(jobs, self.async_concurrency, self.label, on_result, self.cache, self.metrics)
+        except Exception as e:
+            for job in jobs:
+                if job[1] not in finished:
+                    self.report_error(job, "Herunterladen", e)
+
+    def _convert_stage(self, executor, convert_queue, upload_queue):
+        while True:
+            item = convert_queue.get()
+            if item is _DONE:
+                return
+            job, content, validators = item
+            storage_path, local_pdf_path, _, _, _ = job
+            try:
+                with timed(self.metrics, "receipt_convert") as timer:
+                    if executor is None:
+                        pdf = convert_image(content)
+                    else:
+                        pdf = executor.submit(convert_image, content).result()
+                    timer.bytes = len(pdf)
+                with open(local_pdf_path, 'wb') as f:
+                    f.write(pdf)
+                if self.cache is not None:
+                    self.cache.store(storage_path, validators, pdf_bytes=pdf)
+                logger.debug("Bild in PDF umgewandelt: %s", local_pdf_path)
+                self.tally(job, 'converted')
+                upload_queue.put(job)
+            except Exception as e:
+                self.report_error(job, "Umwandeln", e)
+
+    def _upload_stage(self, upload_queue):
+        while True:
+            job = upload_queue.get()
+            if job is _DONE:
+                return
+            if job[0] is _LIST:
+                try:
+                    self.uploader.folder_files(job[1])
+                except Exception as e:
+                    # Die Uploads in diesen Ordner laden die Auflistung erneut und melden den Fehler pro Zeile
+                    logger.warning("Fehler beim Auflisten des Drive-Ordners %s: %s", job[1], e)
+                continue
+            _, local_pdf_path, file_name, folder_id, _ = job
+            try:
+                if self.uploader.upload(local_pdf_path, file_name, folder_id):
+                    self.tally(job, 'ok')
+                else:
+                    self.report_error(job, "Hochladen", "Upload fehlgeschlagen")
+            except Exception as e:
+                self.report_error(job, "Hochladen", e)
+
+    # Startet eine Stufe mit n Threads
+    @staticmethod
+    def _start(n, target, *args):
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    # Beendet eine Stufe: ein Endmarker pro Thread, dann warten
+    @staticmethod
+    def _finish(threads, stage_queue):
+        for _ in threads:
+            stage_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    # Verarbeitet alle Aufträge; gibt die Liste der Fehler (job, stage, message) zurück
+    def run(self, jobs):
+        self.errors = []
+        self.bucket_counts = {}
+        # Gleicher Zielpfad nur einmal (wie beim sequentiellen Überschreiben gewinnt der letzte)
+        jobs = list({job[1]: job for job in jobs}.values())
+        if not jobs:
+            return self.errors
+
+        in_queue = queue.Queue(self.queue_size)
+        convert_queue = queue.Queue(self.queue_size)
+        upload_queue = queue.Queue(self.queue_size)
+
+        self.cache = ReceiptCache() if receipt_cache_enabled() else None
+        executor = ProcessPoolExecutor(self.convert_workers) if self.convert_workers > 0 else None
+        try:
+            upload_threads = self._start(self.upload_workers, self._upload_stage, upload_queue)
+            # Ordner-Auflistungen laden die Upload-Threads parallel vorab, während die Downloads laufen;
+            # die Uploads lesen danach nur noch den Cache
+            for folder_id in dict.fromkeys(job[3] for job in jobs):
+                upload_queue.put((_LIST, folder_id))
+            convert_threads = self._start(max(1, self.convert_workers), self._convert_stage,
+                                          executor, convert_queue, upload_queue)
+            if self.engine == "async":
+                download_thread = threading.Thread(target=self._async_download_stage,
+                                                   args=(jobs, convert_queue, upload_queue), daemon=True)
+                download_thread.start()
+                download_thread.join()
+            else:
+                download_threads = self._start(self.download_workers, self._download_stage,
+                                               in_queue, convert_queue, upload_queue)
+                for job in jobs:
+                    in_queue.put(job)
+                self._finish(download_threads, in_queue)
+            self._finish(convert_threads, convert_queue)
+            self._finish(upload_threads, upload_queue)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if self.cache is not None:
+                logger.info("Beleg-Cache: %d unverändert, %d neu umgewandelt/gespeichert",
+                            self.cache.hits, self.cache.misses)
+                self.cache.evict()
+                self.cache.close()
+                self.cache = None
+        self.log_summary()
+        return self.errors
@@ -0,0 +1,111 @@
+import os
+import math
+import time
+from datetime import datetime, date
+from concurrent.futures import ProcessPoolExecutor
+
+DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+DATE_FORMAT = 'YYYY-MM-DD'
+
+# Funktion zum Umwandeln eines DataFrame-Werts in einen Zellwert (NaN/NaT -> leere Zelle)
+def cell_value(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            return None
+    if isinstance(value, datetime):
+        if value != value:
+            return None
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None)
+    return value
+
+# Funktion zum Erstellen einer Zelle im Write-only-Modus
+def make_cell(worksheet, value, font=None, border=None, alignment=None):
+    from openpyxl.cell import WriteOnlyCell
+
+    cell = WriteOnlyCell(worksheet, value=cell_value(value))
+    if font is not None:
+        cell.font = font
+    if border is not None:
+        cell.border = border
+    if alignment is not None:
+        cell.alignment = alignment
+    if isinstance(cell.value, datetime):
+        cell.number_format = DATETIME_FORMAT
+    elif isinstance(cell.value, date):
+        cell.number_format = DATE_FORMAT
+    return cell
+
+# Funktion zum Schreiben einer Abrechnung in einem Durchgang (openpyxl Write-only-Modus):
+# Kopfblock ab Zeile 1, Tabelle mit Überschrift ab table_start_row (0-basiert wie startrow
+# bei to_excel), Spaltenbreiten und fett gedruckte letzte Zeile (TOTAL).
+def write_report(filename, header_rows, data, table_start_row, column_widths, sheet_name='Sheet1'):
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Border, Side, Alignment
+
+    # Formatierung der Tabellenüberschrift wie bisher durch pandas.to_excel
+    thin = Side(style='thin')
+    header_font = Font(bold=True)
+    header_border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    header_alignment = Alignment(horizontal='center', vertical='top')
+    total_font = Font(bold=True)
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_name)
+    for col, width in column_widths.items():
+        worksheet.column_dimensions[col].width = width
+
+    for header_row in header_rows:
+        worksheet.append([cell_value(value) for value in header_row])
+    for _ in range(table_start_row - len(header_rows)):
+        worksheet.append([])
+
+    worksheet.append([
+        make_cell(worksheet, column, header_font, header_border, header_alignment) for column in data.columns
+    ])
+    previous = None
+    for row in data.itertuples(index=False, name=None):
+        if previous is not None:
+            worksheet.append([make_cell(worksheet, value) for value in previous])
+        previous = row
+    if previous is not None:
+        worksheet.append([make_cell(worksheet, value, total_font) for value in previous])
+
+    workbook.save(filename)
+
+# Funktion zum Erstellen einer Abrechnung im Prozess-Pool; gibt statt einer Ausnahme die Fehlermeldung
+# zurück, zusammen mit Dauer und Dateigrösse für den Laufbericht: (Fehler, Sekunden, Bytes)
+def render_report(report_args):
+    started = time.monotonic()
+    try:
+        write_report(*report_args)
+        return None, time.monotonic() - started, os.path.getsize(report_args[0])
+    except Exception as e:
+        return str(e), time.monotonic() - started, 0
+
+# Funktion zum Erstellen mehrerer Abrechnungen auf mehreren Kernen (REPORT_RENDER_WORKERS).
+# reports ist eine Liste (write_report-Argumente, Kontext); liefert (Kontext, Fehler) in der
+# Reihenfolge der Liste, damit Ausgaben und Uploads unabhängig von der Laufzeit gleich geordnet sind.
+# Mit metrics wird jede Datei als "excel_write" erfasst (Dauer im Worker, Dateigrösse).
+def render_reports(reports, workers=None, metrics=None):
+    if workers is None:
+        workers = max(0, int(os.getenv("REPORT_RENDER_WORKERS", os.cpu_count() or 1)))
+    contexts = [context for _, context in reports]
+    report_args = [args for args, _ in reports]
+    if workers <= 1 or len(reports) <= 1:
+        yield from collect_results(contexts, map(render_report, report_args), metrics)
+        return
+    with ProcessPoolExecutor(min(workers, len(reports))) as executor:
+        yield from collect_results(contexts, executor.map(render_report, report_args), metrics)
+
+# Funktion zum Erfassen der Ergebnisse von render_report; liefert (Kontext, Fehler)
+def collect_results(contexts, results, metrics=None):
+    for context, (error, seconds, size) in zip(contexts, results):
+        if metrics is not None:
+            metrics.record("excel_write", seconds, size, error is not None)
+        yield context, error
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Messwerte eines Synchronisationslaufs: Phasen (nacheinander), Aufrufe pro Operation mit
+# Latenz-Histogramm, Bytes und Fehlern sowie einfache Zähler. Am Ende jeder Synchronisation wird
+# ein Laufbericht als JSON geschrieben (RUN_REPORT_DIR, RUN_REPORT=0 schaltet ihn ab) und optional
+# das Prometheus-Textformat für den Textfile-Collector (METRICS_PROMETHEUS_DIR).
+RUN_REPORT_DIR = os.path.join('exports', 'run_reports')
+
+# Obergrenzen der Histogramm-Klassen in Sekunden (wie die Prometheus-Standardklassen, ergänzt bis 2 Minuten)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRIC_PREFIX = 'lms_sync'
+
+# Funktion zum Prüfen, ob der Laufbericht geschrieben werden soll
+def run_report_enabled():
+    return os.getenv("RUN_REPORT", "1").lower() not in ("0", "false", "no")
+
+# Zustand einer Operation: Aufrufe, Fehler, Bytes, Summe/Maximum der Latenz und Histogramm
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, seconds, size=0, error=False):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.bytes += size or 0
+        self.seconds_total += seconds
+        self.seconds_max = max(self.seconds_max, seconds)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    # Kumulierte Klassen wie bei Prometheus (le = "kleiner oder gleich")
+    def histogram(self):
+        histogram = {}
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            total += count
+            histogram[str(bound)] = total
+        histogram['+Inf'] = self.calls
+        return histogram
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'seconds_total': round(self.seconds_total, 3),
+            'seconds_max': round(self.seconds_max, 3),
+            'histogram': self.histogram()
+        }
+
+# Eine laufende Messung; bytes und error können innerhalb des with-Blocks gesetzt werden
+class Timer:
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+        self.bytes = 0
+        self.error = False
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.metrics is not None:
+            self.metrics.record(self.operation, time.monotonic() - self.started, self.bytes,
+                                self.error or exc_type is not None)
+        return False
+
+# Funktion zum Messen einer Operation; mit metrics=None wird nichts erfasst
+def timed(metrics, operation):
+    return Timer(metrics, operation)
+
+class RunMetrics:
+    def __init__(self, table):
+        self.table = table
+        self.lock = threading.Lock()
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.operations = {}
+        self.counters = {}
+        self.phases = {}
+        self.phase = None
+        self.phase_started = None
+
+    # Erfasst einen Aufruf (thread-sicher, auch aus den Pipeline-Threads)
+    def record(self, operation, seconds, size=0, error=False):
+        with self.lock:
+            self.operations.setdefault(operation, OperationStats()).add(seconds, size, error)
+
+    # Erhöht einen Zähler (z. B. übersprungene Uploads oder Cache-Treffer)
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Beendet die laufende Phase und beginnt die nächste (None beendet nur)
+    def mark(self, phase):
+        now = time.monotonic()
+        with self.lock:
+            if self.phase is not None:
+                self.phases[self.phase] = self.phases.get(self.phase, 0.0) + now - self.phase_started
+            self.phase = phase
+            self.phase_started = now
+
+    def report(self, ok=None):
+        with self.lock:
+            return {
+                'table': self.table,
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'duration_seconds': round(time.monotonic() - self.started, 3),
+                'ok': ok,
+                'phases': {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+                'operations': {operation: stats.as_dict() for operation, stats in sorted(self.operations.items())},
+                'counters': dict(sorted(self.counters.items()))
+            }
+
+    # Messwerte im Prometheus-Textformat (Labels table, operation bzw. phase)
+    def prometheus(self, ok=None):
+        report = self.report(ok)
+        table = report['table']
+        lines = [
+            f"# HELP {METRIC_PREFIX}_operation_duration_seconds Latenz der Aufrufe pro Operation.",
+            f"# TYPE {METRIC_PREFIX}_operation_duration_seconds histogram",
+        ]
+        for operation, stats in report['operations'].items():
+            labels = f'table="{table}",operation="{operation}"'
+            for bound, count in stats['histogram'].items():
+                lines.append(f'{METRIC_PREFIX}_operation_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f"{METRIC_PREFIX}_operation_duration_seconds_sum{{{labels}}} {stats['seconds_total']}")
+            lines.append(f"{METRIC_PREFIX}_operation_duration_seconds_count{{{labels}}} {stats['calls']}")
+        for name, help_text, key in (
+            ('operation_errors_total', 'Fehlgeschlagene Aufrufe pro Operation.', 'errors'),
+            ('operation_bytes_total', 'Übertragene Bytes pro Operation.', 'bytes'),
+        ):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+            for operation, stats in report['operations'].items():
+                lines.append(f'{METRIC_PREFIX}_{name}{{table="{table}",operation="{operation}"}} {stats[key]}')
+        lines.append(f"# HELP {METRIC_PREFIX}_events_total Zähler des Laufs (übersprungene Uploads, Cache-Treffer, ...).")
+        lines.append(f"# TYPE {METRIC_PREFIX}_events_total counter")
+        for name, value in report['counters'].items():
+            lines.append(f'{METRIC_PREFIX}_events_total{{table="{table}",event="{name}"}} {value}')
+        lines.append(f"# HELP {METRIC_PREFIX}_phase_duration_seconds Dauer der Phasen des letzten Laufs.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_phase_duration_seconds gauge")
+        for phase, seconds in report['phases'].items():
+            lines.append(f'{METRIC_PREFIX}_phase_duration_seconds{{table="{table}",phase="{phase}"}} {seconds}')
+        lines.append(f"# HELP {METRIC_PREFIX}_run_duration_seconds Dauer des letzten Laufs.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge")
+        lines.append(f'{METRIC_PREFIX}_run_duration_seconds{{table="{table}"}} {report["duration_seconds"]}')
+        lines.append(f"# HELP {METRIC_PREFIX}_run_success 1, wenn der letzte Lauf fehlerfrei war.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_run_success gauge")
+        lines.append(f'{METRIC_PREFIX}_run_success{{table="{table}"}} {1 if ok else 0}')
+        lines.append(f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Ende des letzten Laufs (Unix-Zeit).")
+        lines.append(f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge")
+        lines.append(f'{METRIC_PREFIX}_run_timestamp_seconds{{table="{table}"}} {int(time.time())}')
+        return "\n".join(lines) + "\n"
+
+    # Beendet den Lauf: Zusammenfassung ausgeben, Laufbericht (JSON) und optional Prometheus-Datei
+    # schreiben. Gibt ok zurück, damit die Synchronisation mit "return metrics.finish(ok)" enden kann.
+    def finish(self, ok):
+        self.mark(None)
+        report = self.report(ok)
+        phases = ", ".join(f"{phase} {seconds:.1f} s" for phase, seconds in report['phases'].items())
+        logger.info("Laufzeit %s: %.1f s (%s)", self.table, report['duration_seconds'], phases,
+                    extra={'table': self.table, 'duration_seconds': report['duration_seconds'],
+                           'phases': report['phases']})
+        for operation, stats in report['operations'].items():
+            logger.info("  %s: %d Aufrufe, %d Fehler, %.1f MB, %.1f s (max. %.2f s)", operation, stats['calls'],
+                        stats['errors'], stats['bytes'] / 1024 / 1024, stats['seconds_total'], stats['seconds_max'])
+        try:
+            if run_report_enabled():
+                report_dir = os.getenv("RUN_REPORT_DIR", RUN_REPORT_DIR)
+                os.makedirs(report_dir, exist_ok=True)
+                report_file = os.path.join(report_dir, f"{self.table}_{self.started_at.strftime('%Y%m%d_%H%M%S')}.json")
+                write_atomic(report_file, json.dumps(report, indent=2, ensure_ascii=False))
+                logger.info("Laufbericht gespeichert: %s", report_file)
+            prometheus_dir = os.getenv("METRICS_PROMETHEUS_DIR")
+            if prometheus_dir:
+                os.makedirs(prometheus_dir, exist_ok=True)
+                write_atomic(os.path.join(prometheus_dir, f"{METRIC_PREFIX}_{self.table}.prom"), self.prometheus(ok))
+        except Exception as e:
+            # Ein fehlender Bericht soll die Synchronisation nicht scheitern lassen
+            logger.error("Fehler beim Schreiben des Laufberichts für %s: %s", self.table, e)
+        return ok
+
+# Funktion zum atomaren Schreiben einer Textdatei (der Textfile-Collector liest nie eine halbe Datei)
+def write_atomic(path, text):
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_file, path)
@@ -1,4 +1,2 @@
 #!/bin/bash
-python sync_purchases.py &
-python sync_expenses.py &
-python sync_campaigns.py &
+python sync_all.py &
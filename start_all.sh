@@ -6,12 +6,10 @@ PROJECT_DIR="/Users/sandrogansner/sync_project"
 # Aktiviere die virtuelle Umgebung
 source "$PROJECT_DIR/venv/bin/activate"
 
-# Starte alle Skripte gleichzeitig im Hintergrund
-python "$PROJECT_DIR/sync_purchases.py" &
-python "$PROJECT_DIR/sync_expenses.py" &
-python "$PROJECT_DIR/sync_campaigns.py" &
+# Starte alle Synchronisationen in einem Prozess im Hintergrund
+python "$PROJECT_DIR/sync_all.py" &
 
-# Warte kurz, um sicherzustellen, dass alle Prozesse gestartet sind
+# Warte kurz, um sicherzustellen, dass der Prozess gestartet ist
 sleep 1
 
-echo "Alle Skripte wurden gestartet. Sie laufen im Hintergrund."
+echo "Alle Synchronisationen wurden gestartet. Sie laufen im Hintergrund."
@@ -0,0 +1,248 @@
+import os
+import logging
+import threading
+import importlib.util
+from run_metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Standard-Seitengrösse für das Abrufen aus PostgREST. Sollte nicht grösser sein
+# als das serverseitige max-rows-Limit, funktioniert aber auch darüber korrekt.
+DEFAULT_PAGE_SIZE = 1000
+
+# Funktion zum Erstellen der Header für Supabase-Anfragen
+def supabase_headers():
+    api_key = os.getenv("API_KEY")
+    return {
+        "apikey": api_key,
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+# Timeouts (Verbindungsaufbau, Lesen) in Sekunden
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+
+# Wiederholungen bei 429/5xx und Verbindungsfehlern mit exponentiellem Backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Vorhandene Spalten pro Tabelle (einmal pro Prozess ermittelt)
+_table_columns = {}
+
+# Format der Zeitstempel aus PostgREST (ISO 8601 mit Zeitzone, variable Sekundenbruchteile)
+TIMESTAMP_FORMAT = 'ISO8601'
+
+# Funktion zum Erstellen der gemeinsamen HTTP-Session (Keep-Alive, Pool, Retry/Backoff).
+# Die Poolgrösse richtet sich nach der Anzahl paralleler Downloads pro Beleg-Pipeline mal der
+# Anzahl Pipelines, die gleichzeitig dieselbe Session nutzen (SYNC_CONCURRENT im Orchestrator).
+def create_session(pipelines=1):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=int(os.getenv("SUPABASE_RETRIES", 5)),
+        backoff_factor=float(os.getenv("SUPABASE_BACKOFF", 0.5)),
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    per_pipeline = int(os.getenv("RECEIPT_DOWNLOAD_WORKERS", 8)) + 2
+    pool_size = int(os.getenv("SUPABASE_POOL_SIZE", max(10, per_pipeline * max(1, pipelines))))
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(supabase_headers())
+    return session
+
+# Funktion zum Abrufen der gemeinsamen Session (wird beim ersten Aufruf erstellt; der Orchestrator
+# ruft sie zuerst mit der Anzahl gleichzeitiger Synchronisationen auf)
+def get_session(pipelines=1):
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session(pipelines)
+        return _session
+
+# Funktion zum Ermitteln der Timeouts (SUPABASE_CONNECT_TIMEOUT, SUPABASE_READ_TIMEOUT)
+def get_timeout():
+    return (
+        float(os.getenv("SUPABASE_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+        float(os.getenv("SUPABASE_READ_TIMEOUT", DEFAULT_READ_TIMEOUT))
+    )
+
+# Funktion für GET-Anfragen an Supabase (REST und Storage) über die gemeinsame Session
+def supabase_get(path, **kwargs):
+    kwargs.setdefault("timeout", get_timeout())
+    return get_session().get(f"{os.getenv('SUPABASE_URL')}{path}", **kwargs)
+
+# Funktion zum Ermitteln der konfigurierten Seitengrösse (SUPABASE_PAGE_SIZE)
+def get_page_size(page_size=None):
+    if page_size:
+        return int(page_size)
+    return int(os.getenv("SUPABASE_PAGE_SIZE", DEFAULT_PAGE_SIZE))
+
+# Funktion zum Erstellen des Keyset-Filters "nach (created_date_time, id)" für PostgREST
+def keyset_filter(cursor):
+    created_date_time, last_id = cursor
+    return (
+        f'(created_date_time.gt."{created_date_time}",'
+        f'and(created_date_time.eq."{created_date_time}",id.gt.{last_id}))'
+    )
+
+# Funktion zum Dekodieren einer JSON-Antwort, mit orjson direkt auf den Bytes (falls installiert)
+def decode_json(response):
+    if importlib.util.find_spec('orjson') is None:
+        return response.json()
+    import orjson
+    return orjson.loads(response.content)
+
+# Funktion zum Umwandeln der Spalten nach dem Schema einer Tabelle:
+# "category" für wiederkehrende Werte (Gruppierungsschlüssel, Konto, KST), "numeric" für Beträge
+def apply_schema(df, dtypes=None):
+    import pandas as pd
+
+    for column, dtype in (dtypes or {}).items():
+        if column not in df:
+            continue
+        if dtype == "numeric":
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+# Funktion zum Zusammenführen mehrerer Abrufe (z. B. neue und erneut versuchte Zeilen), eindeutig
+# nach id. Die Spaltentypen werden danach neu gesetzt, damit die Kategorien wieder übereinstimmen.
+def merge_frames(frames, dtypes=None):
+    import pandas as pd
+
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return apply_schema(pd.DataFrame(), dtypes)
+    if len(frames) == 1:
+        return apply_schema(frames[0], dtypes)
+    merged = pd.concat(frames, ignore_index=True).drop_duplicates(subset='id', keep='last')
+    return apply_schema(merged.reset_index(drop=True), dtypes)
+
+# Funktion zum Umwandeln der Zeitstempel mit festem Format (ohne Formaterkennung pro Wert)
+def parse_timestamps(series):
+    import pandas as pd
+
+    try:
+        return pd.to_datetime(series, format=TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        # pandas < 2.0 kennt format='ISO8601' nicht
+        return pd.to_datetime(series)
+
+# Funktion zum Ermitteln der vorhandenen Spalten einer Tabelle anhand einer Stichprobenzeile.
+# Gibt None zurück, wenn die Tabelle leer ist oder die Abfrage fehlschlägt; nur gefundene Spalten
+# werden zwischengespeichert, damit der nächste Lauf es erneut versucht.
+def table_columns(table_name):
+    if table_name not in _table_columns:
+        response = supabase_get(f"/rest/v1/{table_name}", params={"select": "*", "limit": 1})
+        rows = decode_json(response) if response.status_code == 200 else []
+        if not rows:
+            return None
+        _table_columns[table_name] = set(rows[0])
+    return _table_columns[table_name]
+
+# Funktion zum Erstellen der Spaltenauswahl (select=) für PostgREST. Nicht vorhandene Spalten
+# werden weggelassen, damit optionale Spalten keinen Fehler auslösen.
+def select_list(table_name, columns=None):
+    if not columns:
+        return "*"
+    available = table_columns(table_name)
+    if available is None:
+        return "*"
+    return ",".join(column for column in columns if column in available)
+
+# Funktion zum Erstellen der Zeitraum-Filter auf created_date_time für PostgREST.
+# since ist ein ISO-Datum/-Zeitpunkt, month ein Monat im Format JJJJ_MM oder JJJJ-MM.
+def created_filters(since=None, month=None):
+    filters = []
+    if since:
+        filters.append(("created_date_time", f"gte.{since}"))
+    if month:
+        year, month_number = (int(part) for part in month.replace('-', '_').split('_'))
+        if not 1 <= month_number <= 12:
+            raise ValueError(f"Ungültiger Monat: {month}")
+        next_year, next_month = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+        filters.append(("created_date_time", f"gte.{year:04d}-{month_number:02d}-01"))
+        filters.append(("created_date_time", f"lt.{next_year:04d}-{next_month:02d}-01"))
+    return filters
+
+# Funktion zum seitenweisen Abrufen einer Supabase-Tabelle (Keyset-Pagination über
+# created_date_time und id). Mit since=(created_date_time, id) werden nur Zeilen nach
+# dieser Hochwassermarke geholt, filters ist eine Liste (Spalte, "op.wert") für PostgREST,
+# columns die benötigten Spalten (sonst alle). Liefert die Zeilen als Liste pro Seite. Es wird
+# erst bei einer leeren Seite abgebrochen, damit ein serverseitiges max-rows-Limit keine
+# Zeilen verschluckt. Mit metrics wird jede Seite als "supabase_page" erfasst.
+# Zeilen ohne created_date_time werden ausgelassen: PostgREST sortiert sie ans Ende, der Cursor
+# wäre dann kein Zeitstempel mehr, und ohne Monat lassen sie sich keiner Abrechnung zuordnen.
+def fetch_pages(table_name, page_size=None, since=None, filters=None, columns=None, metrics=None):
+    page_size = get_page_size(page_size)
+    select = select_list(table_name, columns)
+    cursor = since
+    while True:
+        params = [("select", select), ("order", "created_date_time.asc,id.asc"), ("limit", page_size),
+                  ("created_date_time", "not.is.null")]
+        params.extend(filters or [])
+        if cursor is not None:
+            params.append(("or", keyset_filter(cursor)))
+        with timed(metrics, "supabase_page") as timer:
+            response = supabase_get(f"/rest/v1/{table_name}", params=params)
+            timer.bytes = len(response.content)
+            timer.error = response.status_code != 200
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} - {response.text}")
+        rows = decode_json(response)
+        if not rows:
+            return
+        yield rows
+        cursor = (rows[-1]['created_date_time'], rows[-1]['id'])
+
+# Funktion zum seitenweisen Abrufen als DataFrames (ein DataFrame pro Seite)
+def fetch_frames(table_name, page_size=None, since=None, filters=None, columns=None, metrics=None):
+    import pandas as pd
+
+    for rows in fetch_pages(table_name, page_size, since, filters, columns, metrics):
+        yield pd.DataFrame(rows)
+
+# Funktion zum Abrufen von Daten aus einer Supabase-Tabelle als DataFrame (Spaltentypen nach dtypes).
+# Mit strict=True wird ein Fehler nach der Ausgabe weitergereicht statt leer zurückzukehren.
+# Der Speicherbedarf wächst mit der Anzahl abgerufener Zeilen: alle Seiten werden gesammelt und
+# zusammengefügt (Spitze etwa das Doppelte des Ergebnisses). Klein bleibt er nur durch die
+# Hochwassermarke; ein Erstlauf oder SYNC_FULL_REFRESH=1 hält die ganze Tabelle im Speicher.
+def fetch_data(table_name, page_size=None, since=None, filters=None, columns=None, dtypes=None, strict=False,
+               metrics=None):
+    import pandas as pd
+
+    try:
+        with timed(metrics, "fetch_data"):
+            frames = list(fetch_frames(table_name, page_size, since, filters, columns, metrics))
+    except Exception as e:
+        logger.error("Fehler beim Abrufen von %s: %s", table_name, e)
+        if strict:
+            raise
+        return pd.DataFrame()
+    if not frames:
+        return pd.DataFrame()
+    # Kategorien erst nach dem Zusammenfügen bilden, damit alle Seiten dieselben Kategorien teilen
+    return apply_schema(pd.concat(frames, ignore_index=True), dtypes)
+
+# Anzahl IDs pro Abfrage beim Abrufen nach ID (hält die URL kurz)
+ID_CHUNK_SIZE = 100
+
+# Funktion zum Abrufen bestimmter Zeilen nach ID (z. B. fehlgeschlagene Zeilen früherer Läufe)
+def fetch_ids(table_name, ids, columns=None, dtypes=None, strict=False, metrics=None):
+    frames = []
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        chunk = ",".join(str(row_id) for row_id in ids[start:start + ID_CHUNK_SIZE])
+        frames.append(fetch_data(table_name, filters=[("id", f"in.({chunk})")], columns=columns, dtypes=dtypes,
+                                 strict=strict, metrics=metrics))
+    return merge_frames(frames, dtypes)
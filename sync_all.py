@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from drive_service import build_drive_service
+from drive_folders import FolderResolver
+from supabase_client import get_session, created_filters
+from sync_logging import setup_logging
+import sync_purchases
+import sync_expenses
+import sync_campaigns
+
+logger = logging.getLogger(__name__)
+
+# Gemeinsamer Einstiegspunkt für alle Synchronisationen in einem Prozess: Abhängigkeiten werden
+# einmal geladen, alle Läufe teilen sich eine OAuth-Sitzung, einen Drive-Dienst und den HTTP-Pool
+# für Supabase. Mit SYNC_CONCURRENT=1 laufen die drei Synchronisationen gleichzeitig.
+# Ein Eintrag ist (Startzeit, Tabelle, Bezeichnung, Synchronisationsfunktion).
+JOBS = [
+    ("02:00", "purchases", "Einkäufe", sync_purchases.sync_purchases),
+    ("02:05", "expenses", "Kostenabrechnungen", sync_expenses.sync_expenses),
+    ("02:10", "campaigns", "Kampagnen", sync_campaigns.sync_campaigns),
+]
+# Spalte des Gruppierungsschlüssels pro Tabelle (Kreditkarte, Mitarbeiter:in, Projekt)
+KEY_COLUMNS = {
+    "purchases": sync_purchases.KEY_COLUMN,
+    "expenses": sync_expenses.KEY_COLUMN,
+    "campaigns": sync_campaigns.KEY_COLUMN,
+}
+# Oberste Drive-Ordner pro Tabelle ("Belege" teilen sich alle Synchronisationen)
+ROOT_FOLDERS = {
+    "purchases": sync_purchases.ROOT_FOLDERS,
+    "expenses": sync_expenses.ROOT_FOLDERS,
+    "campaigns": sync_campaigns.ROOT_FOLDERS,
+}
+TABLES = [table for _, table, _, _ in JOBS]
+
+# Funktion zum Prüfen, ob die Synchronisationen gleichzeitig laufen sollen
+def concurrent_requested():
+    return os.getenv("SYNC_CONCURRENT", "").lower() in ("1", "true", "yes")
+
+# Funktion zum Ausführen einer Synchronisation; ein Fehler beendet den Orchestrator nicht.
+# Gibt False zurück, wenn die Synchronisation fehlgeschlagen oder mit Fehlern beendet wurde.
+def run_job(name, job, drive_service=None, filters=None):
+    try:
+        return job(drive_service, filters) is not False
+    except Exception as e:
+        logger.error("Fehler bei der Synchronisation der %s: %s", name, e)
+        return False
+
+# Funktion zum Erstellen der PostgREST-Filter einer Tabelle (Zeitraum und optional Gruppierungsschlüssel)
+def job_filters(table, args):
+    filters = created_filters(args.since, args.month)
+    if args.key:
+        filters.append((KEY_COLUMNS[table], f"eq.{args.key}"))
+    return filters
+
+# Funktion zum einmaligen Anlegen der gemeinsamen obersten Ordner vor den gleichzeitigen Läufen,
+# damit nicht mehrere Threads gleichzeitig einen eigenen "Belege"-Ordner erstellen
+def resolve_root_folders(jobs=JOBS):
+    folder_paths = [path for _, table, _, _ in jobs for path in ROOT_FOLDERS[table]]
+    try:
+        folders = FolderResolver(build_drive_service())
+        folders.warm(sorted({path[0] for path in folder_paths}))
+        folders.ensure_paths(folder_paths)
+    except Exception as e:
+        logger.error("Fehler beim Anlegen der obersten Drive-Ordner: %s", e)
+
+# Funktion zum Ausführen aller Synchronisationen gleichzeitig (je Thread ein eigener Drive-Dienst,
+# da httplib2 nicht thread-sicher ist; die Anmeldedaten werden geteilt)
+def run_concurrent(jobs=JOBS, filters=None):
+    logger.info("Starte alle Synchronisationen gleichzeitig")
+    resolve_root_folders(jobs)
+    results = {}
+
+    def run(table, name, job):
+        results[table] = run_job(name, job, build_drive_service(), (filters or {}).get(table))
+
+    threads = [threading.Thread(target=run, args=(table, name, job)) for _, table, name, job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return all(results.values())
+
+# Funktion zum Ausführen aller Synchronisationen nacheinander mit dem gemeinsamen Drive-Dienst
+# (wird erst angemeldet, wenn eine Synchronisation neue Zeilen hat)
+def run_sequential(jobs=JOBS, filters=None):
+    results = [run_job(name, job, None, (filters or {}).get(table)) for _, table, name, job in jobs]
+    return all(results)
+
+# Funktion zum Einlesen der Kommandozeilenargumente
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Synchronisiert Einkäufe, Kostenabrechnungen und Kampagnen aus Supabase nach Google Drive."
+    )
+    parser.add_argument("--concurrent", action="store_true",
+                        help="alle Synchronisationen gleichzeitig ausführen (wie SYNC_CONCURRENT=1)")
+    parser.add_argument("--once", action="store_true",
+                        help="einmal synchronisieren und beenden (Exit-Code 1 bei Fehlern, z. B. für Cron/CI)")
+    parser.add_argument("--table", action="append", choices=TABLES,
+                        help="nur diese Tabelle synchronisieren (mehrfach möglich)")
+    parser.add_argument("--since", help="nur Zeilen ab diesem Datum/Zeitpunkt (ISO, z. B. 2024-05-01), nur mit --once")
+    parser.add_argument("--month", help="nur Zeilen dieses Monats (JJJJ_MM oder JJJJ-MM), nur mit --once")
+    parser.add_argument("--key", help="nur diese Kreditkarte, Mitarbeiter:in bzw. dieses Projekt, nur mit --once")
+    args = parser.parse_args(argv)
+    if (args.since or args.month or args.key) and not args.once:
+        parser.error("--since, --month und --key sind nur zusammen mit --once möglich")
+    if args.month:
+        try:
+            created_filters(month=args.month)
+        except ValueError:
+            parser.error(f"ungültiger Monat: {args.month}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    jobs = [entry for entry in JOBS if not args.table or entry[1] in args.table]
+    # Filter pro Tabelle, werden als Query-Parameter an PostgREST übergeben
+    filters = {table: job_filters(table, args) for _, table, _, _ in jobs}
+
+    import schedule
+    from dotenv import load_dotenv
+
+    # Lade die Umgebungsvariablen aus der .env-Datei
+    load_dotenv()
+
+    # Logging einrichten (LOG_LEVEL, LOG_FORMAT) und prüfen, ob die Umgebungsvariablen geladen wurden;
+    # der API-Schlüssel selbst wird nie ausgegeben
+    setup_logging()
+    logger.info("SUPABASE_URL: %s, API_KEY %s", os.getenv('SUPABASE_URL'), "gesetzt" if os.getenv('API_KEY') else "fehlt")
+
+    # Gemeinsamer HTTP-Pool für Supabase, gross genug für alle gleichzeitig laufenden Beleg-Pipelines
+    concurrent = args.concurrent or concurrent_requested()
+    get_session(len(jobs) if concurrent else 1)
+    if args.once:
+        ok = run_concurrent(jobs, filters) if concurrent else run_sequential(jobs, filters)
+        if not ok:
+            logger.error("Synchronisation mit Fehlern beendet.")
+        return 0 if ok else 1
+
+    if concurrent:
+        # Teste die Synchronisation sofort beim Start und plane sie täglich zur ersten Startzeit
+        run_concurrent(jobs)
+        schedule.every().day.at(jobs[0][0]).do(run_concurrent, jobs)
+    else:
+        run_sequential(jobs)
+        # Plane die Synchronisationen täglich zu ihren bisherigen Zeiten
+        for at, _, name, job in jobs:
+            schedule.every().day.at(at).do(run_job, name, job)
+
+    # Starte den Scheduler
+    logger.info("Starte Synchronisation... Drücke Ctrl+C zum Beenden.")
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
+
+if __name__ == "__main__":
+    sys.exit(main())
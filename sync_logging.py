@@ -0,0 +1,76 @@
+import os
+import re
+import sys
+import json
+import logging
+from datetime import datetime, timezone
+
+# Logging für alle Synchronisationen. Stufe über LOG_LEVEL (Standard INFO; DEBUG zeigt zusätzlich
+# die Meldungen pro Beleg und Datei), LOG_FORMAT=json gibt eine JSON-Zeile pro Meldung aus (für
+# Log-Shipping). Geheimnisse (API-Schlüssel, Tokens) werden vor der Ausgabe unkenntlich gemacht.
+DEFAULT_LEVEL = "INFO"
+TEXT_FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+# Umgebungsvariablen, deren Werte nie im Log erscheinen dürfen
+SECRET_ENV_VARS = ('API_KEY', 'SUPABASE_KEY', 'SUPABASE_ANON_KEY', 'SUPABASE_SERVICE_ROLE_KEY')
+SECRET_PATTERNS = [
+    # Authorization-Header
+    re.compile(r'(Bearer\s+)[A-Za-z0-9\-._~+/]+=*', re.IGNORECASE),
+    # Schlüssel/Token als Parameter, Header oder JSON-Feld
+    re.compile(r'((?:apikey|api_key|access_token|refresh_token|client_secret|password)["\']?\s*[=:]\s*["\']?)'
+               r'[^\s"\'&,}]+', re.IGNORECASE),
+    # JWTs (Supabase-Schlüssel)
+    re.compile(r'()eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+'),
+]
+REDACTED = '***'
+
+# Bibliotheken, die pro Anfrage auf INFO loggen würden
+QUIET_LOGGERS = {'httpx': logging.WARNING, 'httpcore': logging.WARNING, 'urllib3': logging.WARNING,
+                 'googleapiclient.discovery_cache': logging.ERROR, 'pikepdf': logging.WARNING}
+
+# Standardattribute eines LogRecord; alles andere stammt aus extra= und geht ins JSON
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+# Funktion zum Unkenntlichmachen von Geheimnissen in einem Text
+def redact(text):
+    for name in SECRET_ENV_VARS:
+        value = os.getenv(name)
+        if value and len(value) >= 8:
+            text = text.replace(value, REDACTED)
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(lambda match: match.group(1) + REDACTED, text)
+    return text
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+# Eine JSON-Zeile pro Meldung: Zeit (UTC), Stufe, Logger, Meldung, Felder aus extra= und Ausnahme
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = redact(value) if isinstance(value, str) else value
+        if record.exc_info:
+            entry['exception'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Funktion zum Einrichten des Loggings (einmal pro Prozess im Einstiegspunkt, nach load_dotenv)
+def setup_logging(level=None, log_format=None, stream=None):
+    level = (level or os.getenv("LOG_LEVEL", DEFAULT_LEVEL)).upper()
+    log_format = (log_format or os.getenv("LOG_FORMAT", "text")).lower()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else RedactingFormatter(TEXT_FORMAT))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, quiet_level in QUIET_LOGGERS.items():
+        logging.getLogger(name).setLevel(max(quiet_level, root.level))
@@ -1,189 +1,112 @@
 
 import os
-import requests
-import pandas as pd
-import schedule
 import time
-from datetime import datetime
-from dotenv import load_dotenv
-from openpyxl import load_workbook
-from openpyxl.styles import Font
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-import pickle
-import img2pdf
-
-# Lade die Umgebungsvariablen aus der .env-Datei
-load_dotenv()
-
-# Hole die Werte aus der .env-Datei
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-API_KEY = os.getenv("API_KEY")
-
-# Debugging: Überprüfe, ob die Umgebungsvariablen geladen wurden
-print(f"SUPABASE_URL: {SUPABASE_URL}")
-print(f"API_KEY: {API_KEY}")
-
-# Setze die Header für die Anfrage
-headers = {
-    "apikey": API_KEY,
-    "Authorization": f"Bearer {API_KEY}",
-    "Content-Type": "application/json"
+import logging
+from supabase_client import fetch_data, fetch_ids, merge_frames, parse_timestamps
+from drive_service import get_drive_service, build_drive_service
+from drive_folders import FolderResolver
+from drive_uploads import DriveUploader
+from receipts import ReceiptPipeline, make_jobs, has_path, failed_rows
+from report_writer import render_reports
+from run_metrics import RunMetrics
+from sync_logging import setup_logging
+from sync_state import (
+    get_high_water, set_high_water, high_water_from, get_retry_ids, record_row_results,
+    bucket_has_rows, import_workbook_rows, upsert_bucket_rows, load_bucket_rows,
+    bucket_fingerprint, get_bucket_fingerprint, set_bucket_fingerprint
+)
+
+logger = logging.getLogger(__name__)
+
+# Spalten für Abrechnung, Gruppierung und Belege (werden per select= bei PostgREST angefragt)
+COLUMNS = [
+    'id', 'created_date_time', 'cardUsed', 'invoiceIssuer', 'itemName', 'account', 'kst', 'project',
+    'vatRate', 'price', 'receiptPath'
+]
+# Spaltentypen beim Einlesen (Kategorien für wiederkehrende Werte, Zahlen für Beträge)
+DTYPES = {
+    'cardUsed': 'category', 'account': 'category', 'kst': 'category', 'project': 'category',
+    'price': 'numeric'
 }
-
-# Google Drive API-Einstellungen
-SCOPES = ['https://www.googleapis.com/auth/drive']
-CREDENTIALS_FILE = 'credentials.json'
-TOKEN_FILE = 'token_purchases.pickle'
-
-# Funktion zum Einrichten des Google Drive-Dienstes
-def get_drive_service():
-    creds = None
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
-    if not creds or not creds.valid:
-        flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-        creds = flow.run_local_server(port=0)
-        with open(TOKEN_FILE, 'wb') as token:
-            pickle.dump(creds, token)
-    return build('drive', 'v3', credentials=creds)
-
-# Funktion zum Erstellen oder Finden eines Ordners in Google Drive
-def get_or_create_folder(drive_service, folder_name, parent_id=None):
-    query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-    if parent_id:
-        query += f" and '{parent_id}' in parents"
-    response = drive_service.files().list(q=query, spaces='drive').execute()
-    folders = response.get('files', [])
-    if folders:
-        return folders[0]['id']
-    else:
-        file_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder'
-        }
-        if parent_id:
-            file_metadata['parents'] = [parent_id]
-        folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-        return folder.get('id')
-
-# Funktion zum Prüfen, ob eine Datei in Google Drive existiert
-def file_exists_in_drive(drive_service, file_name, folder_id):
-    query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-    response = drive_service.files().list(q=query, spaces='drive').execute()
-    files = response.get('files', [])
-    return len(files) > 0
-
-# Funktion zum Hochladen einer Datei nach Google Drive
-def upload_to_drive(drive_service, file_path, file_name, folder_id):
-    if file_exists_in_drive(drive_service, file_name, folder_id):
-        print(f"Datei {file_name} existiert bereits in Google Drive, überspringe Upload.")
-        return
-    try:
-        file_metadata = {
-            'name': file_name,
-            'parents': [folder_id]
-        }
-        media = MediaFileUpload(file_path)
-        file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-        print(f"Datei erfolgreich hochgeladen nach Google Drive: {file_name} (ID: {file.get('id')})")
-    except Exception as e:
-        print(f"Fehler beim Hochladen der Datei {file_name} nach Google Drive: {e}")
-
-# Funktion zum Abrufen von Daten aus einer Supabase-Tabelle
-def fetch_data(table_name):
-    try:
-        response = requests.get(f"{SUPABASE_URL}/rest/v1/{table_name}", headers=headers)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"Fehler beim Abrufen von {table_name}: {response.status_code} - {response.text}")
-            return []
-    except Exception as e:
-        print(f"Fehler beim Abrufen von {table_name}: {e}")
-        return []
-
-# Funktion zum Herunterladen eines Belegs und ggf. Umwandeln in PDF
-def download_receipt(receipt_path, local_image_path, local_pdf_path):
-    try:
-        if not receipt_path:
-            print("Kein receiptPath angegeben.")
-            return False
-        receipt_url = f"{SUPABASE_URL}/storage/v1/object/{receipt_path}"
-        print(f"Versuche, Beleg herunterzuladen von: {receipt_url}")
-        response = requests.get(receipt_url, headers=headers)
-        if response.status_code == 200:
-            # Prüfe, ob die Datei bereits ein PDF ist
-            if receipt_path.lower().endswith('.pdf'):
-                # Speichere das PDF direkt
-                with open(local_pdf_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"PDF-Beleg heruntergeladen: {local_pdf_path}")
-                return True
-            else:
-                # Speichere das Bild temporär
-                with open(local_image_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"Bild heruntergeladen: {local_image_path}")
-                # Wandle das Bild in ein PDF um
-                with open(local_pdf_path, 'wb') as f:
-                    f.write(img2pdf.convert(local_image_path))
-                print(f"Bild in PDF umgewandelt: {local_pdf_path}")
-                # Lösche das temporäre Bild
-                os.remove(local_image_path)
-                return True
-        else:
-            print(f"Fehler beim Herunterladen des Belegs {receipt_path}: {response.status_code} - {response.text}")
-            return False
-    except Exception as e:
-        print(f"Fehler beim Herunterladen oder Umwandeln des Belegs {receipt_path}: {e}")
-        return False
+# Spalte des Gruppierungsschlüssels (Kreditkarte), für Filter wie --key
+KEY_COLUMN = 'cardUsed'
+# Oberste Drive-Ordner der Synchronisation (werden bei gleichzeitigen Läufen vorab angelegt)
+ROOT_FOLDERS = [("Einkäufe",), ("Belege", "Einkäufe")]
 
 # Funktion zur Synchronisation der Einkäufe
-def sync_purchases():
-    print(f"Starte Synchronisation der Einkäufe: {datetime.now()}")
-    purchases = fetch_data("purchases")
-    if not purchases:
-        print("Keine Einkäufe gefunden.")
-        return
-
-    # Konvertiere die Daten in ein DataFrame
-    df_purchases = pd.DataFrame(purchases)
+def sync_purchases(drive_service=None, filters=None):
+    import pandas as pd
+
+    logger.info("Starte Synchronisation der Einkäufe")
+    # Messwerte für den Laufbericht (Phasen, Aufrufe, Latenzen, Bytes, Fehler)
+    metrics = RunMetrics("purchases")
+    metrics.mark("fetch")
+    # Hole seitenweise nur die Einkäufe nach der letzten Hochwassermarke
+    # Mit Filtern (--since/--month/--key) wird unabhängig von der Hochwassermarke geholt
+    high_water = None if filters else get_high_water("purchases")
+    # Zeilen, die in früheren Läufen fehlgeschlagen sind, werden zusätzlich erneut geholt
+    retry_ids = [] if filters else get_retry_ids("purchases")
+    try:
+        df_purchases = fetch_data("purchases", since=high_water, filters=filters, columns=COLUMNS, dtypes=DTYPES,
+                                  strict=True, metrics=metrics)
+        df_retry = fetch_ids("purchases", retry_ids, columns=COLUMNS, dtypes=DTYPES, strict=True, metrics=metrics)
+    except Exception:
+        return metrics.finish(False)
+    new_count = len(df_purchases)
+    new_high_water = high_water_from(df_purchases) if new_count else None
+    df_purchases = merge_frames([df_purchases, df_retry], DTYPES)
     if df_purchases.empty:
-        print("DataFrame ist leer.")
-        return
+        # Nicht mehr vorhandene Zeilen verlassen die Wiederholungsliste
+        record_row_results("purchases", retry_ids, {})
+        logger.info("Keine neuen Einkäufe gefunden.")
+        return metrics.finish(True)
+    metrics.mark("prepare")
+    logger.info("%d neue Einkäufe seit %s, %d fehlgeschlagene erneut versucht", new_count,
+                high_water[0] if high_water else 'Beginn', len(df_retry))
+    # Fehlgeschlagene Zeilen (ID -> Fehlermeldung), sie kommen in die Wiederholungsliste
+    failures = {}
 
     # Konvertiere das created_date_time-Feld und erstelle eine Spalte für Monat/Jahr
-    df_purchases['created_date_time'] = pd.to_datetime(df_purchases['created_date_time'])
+    df_purchases['created_date_time'] = parse_timestamps(df_purchases['created_date_time'])
     df_purchases['month_year'] = df_purchases['created_date_time'].dt.strftime('%Y_%m')
 
-    # Initialisiere Google Drive-Dienst
-    drive_service = get_drive_service()
+    # Initialisiere Google Drive-Dienst (im Orchestrator wird der gemeinsame Dienst übergeben)
+    if drive_service is None:
+        drive_service = get_drive_service()
+
+    # Ordner-Cache (persistiert), einmalig vorgewärmt mit den benötigten Stammordnern
+    folders = FolderResolver(drive_service, metrics=metrics)
+    folders.warm(sorted({path[0] for path in ROOT_FOLDERS}))
+    uploader = DriveUploader(drive_service, folders, service_factory=build_drive_service)
 
-    # Erstelle die Hauptordner in Google Drive
-    einkaufe_folder_id = get_or_create_folder(drive_service, "Einkäufe")
-    belege_folder_id = get_or_create_folder(drive_service, "Belege")
-    belege_einkaufe_folder_id = get_or_create_folder(drive_service, "Einkäufe", belege_folder_id)
+    # Lege alle benötigten Ordner vorab an: fehlende Ordner werden Ebene für Ebene per Batch-Request erstellt
+    folder_paths = list(ROOT_FOLDERS)
+    for card, month_year in df_purchases[['cardUsed', 'month_year']].dropna().drop_duplicates().itertuples(index=False):
+        folder_paths.append(("Einkäufe", card.replace(' ', '_'), month_year))
+        folder_paths.append(("Belege", "Einkäufe", month_year, f"Belege_{card.replace(' ', '_')}_{month_year}"))
+    folder_ids = folders.ensure_paths(folder_paths)
+
+    # Hauptordner in Google Drive
+    einkaufe_folder_id = folders.get_or_create("Einkäufe")
 
     # Gruppiere nach Kreditkarte und Monat (basierend auf created_date_time)
-    grouped = df_purchases.groupby(['cardUsed', 'month_year'])
+    grouped = df_purchases.groupby(['cardUsed', 'month_year'], observed=True)
+    render_jobs = []
+    buckets_skipped = 0
+    buckets_rendered = 0
+    buckets_uploaded = 0
 
     # Erstelle oder aktualisiere Excel-Dateien und Belege-Ordner
     for (card, month_year), group in grouped:
         # Erstelle den Ordner für die Excel-Dateien (lokal und in Google Drive)
         excel_dir = f"exports/Einkäufe/{card.replace(' ', '_')}/{month_year}"
         os.makedirs(excel_dir, exist_ok=True)
-        card_folder_id = get_or_create_folder(drive_service, card.replace(' ', '_'), einkaufe_folder_id)
-        month_folder_id = get_or_create_folder(drive_service, month_year, card_folder_id)
+        card_folder_id = folders.get_or_create(card.replace(' ', '_'), einkaufe_folder_id)
+        month_folder_id = folders.get_or_create(month_year, card_folder_id)
 
-        # Erstelle den Ordner für die Belege (lokal und in Google Drive)
+        # Erstelle den Ordner für die Belege (lokal, der Drive-Ordner wurde vorab angelegt)
         receipts_dir = f"exports/Belege/Einkäufe/{month_year}/Belege_{card.replace(' ', '_')}_{month_year}"
         os.makedirs(receipts_dir, exist_ok=True)
-        belege_month_folder_id = get_or_create_folder(drive_service, month_year, belege_einkaufe_folder_id)
-        belege_card_folder_id = get_or_create_folder(drive_service, f"Belege_{card.replace(' ', '_')}_{month_year}", belege_month_folder_id)
 
         # Wähle die relevanten Spalten für die Excel-Datei
         excel_data = group[[
@@ -195,17 +118,19 @@ def sync_purchases():
             'ID', 'Beleg', 'Rechnungssteller', 'Text', 'Kontierung Konto', 'KST', 'Projekt', 'VAT', 'BETRAG CHF', 'BETRAG EUR'
         ]
 
-        # Überprüfe, ob die Excel-Datei bereits existiert
+        # Die Zeilen werden im Zeilenspeicher zusammengeführt (Upsert nach ID), die Excel-Datei
+        # wird daraus nur noch erzeugt. Bestehende Dateien ohne gespeicherte Zeilen einmalig übernehmen.
         filename = f"{excel_dir}/Einkauf_{card.replace(' ', '_')}_{month_year}.xlsx"
-        if os.path.exists(filename):
+        if os.path.exists(filename) and not bucket_has_rows("purchases", card, month_year):
             try:
-                existing_data = pd.read_excel(filename, skiprows=9)
-                if not existing_data.empty and existing_data.iloc[-1]['ID'] == 'TOTAL':
-                    existing_data = existing_data.iloc[:-1]
-                excel_data = pd.concat([existing_data, excel_data], ignore_index=True)
-                excel_data = excel_data.drop_duplicates(subset=['ID'], keep='last')
+                import_workbook_rows("purchases", card, month_year, filename, 9)
             except Exception as e:
-                print(f"Fehler beim Lesen der bestehenden Excel-Datei {filename}: {e}")
+                # Ohne die bestehenden Zeilen würde die Datei nur mit den neuen Zeilen überschrieben
+                logger.error("Fehler beim Lesen der bestehenden Excel-Datei %s, überspringe Gruppe: %s", filename, e)
+                failures.update(dict.fromkeys(group['id'], f"Excel-Datei lesen: {e}"))
+                continue
+        upsert_bucket_rows("purchases", card, month_year, excel_data)
+        excel_data = load_bucket_rows("purchases", card, month_year, list(excel_data.columns))
 
         # Berechne die Summen
         sum_row = excel_data[['BETRAG CHF']].sum()
@@ -222,66 +147,114 @@ def sync_purchases():
         # Füge die Summenzeile hinzu
         excel_data = pd.concat([excel_data, pd.DataFrame([sum_row])], ignore_index=True)
 
-        # Speichere die Excel-Datei
-        try:
-            with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-                header_data = pd.DataFrame([
-                    ['Kreditkarten-Abrechnung'],
-                    [f"Anbieter: {card}"],
-                    [f"Periode: {month_year.replace('_', ' ')}"],
-                    ['Lenzerheide Marketing+Support AG'],
-                    ['GJ 2024/25']
-                ])
-                header_data.to_excel(writer, sheet_name='Sheet1', startrow=0, index=False, header=False)
-                excel_data.to_excel(writer, sheet_name='Sheet1', startrow=9, index=False)
-
-            workbook = load_workbook(filename)
-            worksheet = workbook['Sheet1']
-            column_widths = {
-                'A': 10, 'B': 10, 'C': 20, 'D': 30, 'E': 15, 'F': 10, 'G': 10, 'H': 10, 'I': 15, 'J': 15
-            }
-            for col, width in column_widths.items():
-                worksheet.column_dimensions[col].width = width
-
-            last_row = worksheet.max_row
-            for col in range(1, worksheet.max_column + 1):
-                cell = worksheet.cell(row=last_row, column=col)
-                cell.font = Font(bold=True)
-
-            workbook.save(filename)
-            print(f"Excel-Datei erstellt/aktualisiert: {filename}")
-            upload_to_drive(drive_service, filename, os.path.basename(filename), month_folder_id)
-
-        except Exception as e:
-            print(f"Fehler beim Erstellen/Aktualisieren der Excel-Datei {filename}: {e}")
-
-        # Lade die Belege herunter, wandle sie in PDF um und lade sie nach Google Drive hoch
-        for index, row in group.iterrows():
-            receipt_path = row['receiptPath']
-            if receipt_path:
-                receipt_id = row['id']
-                item_name = row['itemName'].replace(' ', '_')[:20]
-                # Temporärer Pfad für das Bild
-                temp_image_path = f"{receipts_dir}/temp_{receipt_id}_{item_name}.jpg"
-                # Endgültiger Pfad für das PDF
-                new_filename = f"Beleg_{receipt_id}_{item_name}.pdf"
-                local_pdf_path = f"{receipts_dir}/{new_filename}"
-                if download_receipt(receipt_path, temp_image_path, local_pdf_path):
-                    upload_to_drive(drive_service, local_pdf_path, new_filename, belege_card_folder_id)
+        # Kopfblock und Spaltenbreiten der Excel-Datei
+        header_rows = [
+            ['Kreditkarten-Abrechnung'],
+            [f"Anbieter: {card}"],
+            [f"Periode: {month_year.replace('_', ' ')}"],
+            ['Lenzerheide Marketing+Support AG'],
+            ['GJ 2024/25']
+        ]
+        column_widths = {
+            'A': 10, 'B': 10, 'C': 20, 'D': 30, 'E': 15, 'F': 10, 'G': 10, 'H': 10, 'I': 15, 'J': 15
+        }
+
+        # Erstelle und lade die Excel-Datei nur hoch, wenn sich ihr Inhalt seit dem letzten Export geändert hat
+        fingerprint = bucket_fingerprint(header_rows, excel_data)
+        if os.path.exists(filename) and get_bucket_fingerprint("purchases", card, month_year) == fingerprint:
+            logger.debug("Excel-Datei unverändert, überspringe Erstellung und Upload: %s", filename)
+            buckets_skipped += 1
+        else:
+            # Die Excel-Datei wird nach der Schleife parallel erstellt und hochgeladen
+            render_jobs.append(((filename, header_rows, excel_data, 9, column_widths),
+                                (filename, month_folder_id, card, month_year, fingerprint, list(group['id']))))
+
+
+    metrics.mark("excel")
+    # Erstelle die geänderten Excel-Dateien parallel auf mehreren Kernen; Upload im Hauptprozess
+    # in der Reihenfolge der Gruppen
+    for (filename, month_folder_id, card, month_year, fingerprint, row_ids), error in render_reports(render_jobs, metrics=metrics):
+        if error:
+            logger.error("Fehler beim Erstellen/Aktualisieren der Excel-Datei %s: %s", filename, error)
+            failures.update(dict.fromkeys(row_ids, f"Excel-Datei erstellen: {error}"))
+            continue
+        logger.info("Excel-Datei erstellt/aktualisiert: %s", filename)
+        buckets_rendered += 1
+        uploads_before = uploader.uploaded_count
+        if uploader.upload(filename, os.path.basename(filename), month_folder_id):
+            set_bucket_fingerprint("purchases", card, month_year, fingerprint)
+            if uploader.uploaded_count > uploads_before:
+                buckets_uploaded += 1
+        else:
+            failures.update(dict.fromkeys(row_ids, "Excel-Datei hochladen: Upload fehlgeschlagen"))
+
+    metrics.mark("receipts")
+    # Baue die Beleg-Aufträge aller Gruppen in einem vektorisierten Durchgang
+    receipts = df_purchases[has_path(df_purchases['receiptPath'])].dropna(subset=['cardUsed', 'month_year'])
+    receipts = receipts.sort_values(['cardUsed', 'month_year'], kind='stable')
+    card_dirs = receipts['cardUsed'].str.replace(' ', '_')
+    receipt_folders = "Belege_" + card_dirs + "_" + receipts['month_year']
+    # Endgültiger Pfad für das PDF
+    new_filenames = (
+        "Beleg_" + receipts['id'].astype(str) + "_"
+        + receipts['itemName'].fillna('').astype(str).str.replace(' ', '_').str[:20] + ".pdf"
+    )
+    local_pdf_paths = "exports/Belege/Einkäufe/" + receipts['month_year'] + "/" + receipt_folders + "/" + new_filenames
+    receipt_folder_ids = [
+        folder_ids[("Belege", "Einkäufe", month_year, folder)]
+        for month_year, folder in zip(receipts['month_year'], receipt_folders)
+    ]
+    receipt_jobs = make_jobs(receipts['receiptPath'], local_pdf_paths, new_filenames, receipt_folder_ids,
+                             receipts['cardUsed'], receipts['month_year'])
+
+    # Lade die Belege herunter, wandle sie in PDF um und lade sie nach Google Drive hoch
+    errors = ReceiptPipeline(uploader, label="Beleg").run(receipt_jobs)
+    if errors:
+        failures.update(failed_rows(errors, local_pdf_paths, receipts['id']))
+
+    logger.info("Abrechnungen: %d unverändert übersprungen, %d erstellt, %d hochgeladen",
+                buckets_skipped, buckets_rendered, buckets_uploaded)
+
+    # Fehlgeschlagene Zeilen kommen in die Wiederholungsliste, erfolgreich verarbeitete verlassen sie.
+    # Die Hochwassermarke rückt trotzdem vor, damit eine dauerhaft fehlerhafte Zeile die Tabelle nicht blockiert.
+    record_row_results("purchases", list(df_purchases['id']) + retry_ids, failures)
+    if failures:
+        logger.warning("Synchronisation mit Fehlern beendet, %d Zeilen fehlgeschlagen (Wiederholungsliste).",
+                       len(failures))
+    if filters:
+        logger.info("Gefilterter Lauf, Hochwassermarke bleibt unverändert.")
+    elif new_high_water is not None:
+        set_high_water("purchases", new_high_water)
+    return metrics.finish(not failures)
 
 # Hauptfunktion zur Synchronisation
 def sync_all():
     sync_purchases()
 
-# Plane die Synchronisation täglich um 2:00 Uhr
-schedule.every().day.at("02:00").do(sync_all)
+# Einstiegspunkt für den Einzelbetrieb: Umgebung laden, sofort synchronisieren, dann täglich planen
+def main():
+    import schedule
+    from dotenv import load_dotenv
+
+    # Lade die Umgebungsvariablen aus der .env-Datei
+    load_dotenv()
+
+    # Logging einrichten (LOG_LEVEL, LOG_FORMAT) und prüfen, ob die Umgebungsvariablen geladen wurden;
+    # der API-Schlüssel selbst wird nie ausgegeben
+    setup_logging()
+    logger.info("SUPABASE_URL: %s, API_KEY %s", os.getenv('SUPABASE_URL'), "gesetzt" if os.getenv('API_KEY') else "fehlt")
+
+    # Plane die Synchronisation täglich um 2:00 Uhr
+    schedule.every().day.at("02:00").do(sync_all)
+
+    # Teste die Synchronisation sofort beim Start
+    sync_all()
 
-# Teste die Synchronisation sofort beim Start
-sync_all()
+    # Starte den Scheduler
+    logger.info("Starte Synchronisation... Drücke Ctrl+C zum Beenden.")
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
 
-# Starte den Scheduler
-print("Starte Synchronisation... Drücke Ctrl+C zum Beenden.")
-while True:
-    schedule.run_pending()
-    time.sleep(1)
-EOF
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+import os
+import json
+import math
+import hashlib
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Lokaler Zustandsspeicher für inkrementelle Synchronisation
+STATE_DB = os.path.join('exports', 'sync_state.sqlite')
+
+# Funktion zum Öffnen der Zustandsdatenbank (legt Tabellen bei Bedarf an)
+def connect_state(db_path=None):
+    db_path = db_path or STATE_DB
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS high_water ("
+        " table_name TEXT PRIMARY KEY,"
+        " created_date_time TEXT NOT NULL,"
+        " last_id TEXT NOT NULL,"
+        " synced_at TEXT NOT NULL)"
+    )
+    # Zeilenspeicher pro Abrechnung (table_name, bucket_key, month_year), eindeutig nach ID.
+    # seq hält die Reihenfolge wie bisher concat + drop_duplicates(keep='last').
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS bucket_rows ("
+        " table_name TEXT NOT NULL,"
+        " bucket_key TEXT NOT NULL,"
+        " month_year TEXT NOT NULL,"
+        " row_id TEXT NOT NULL,"
+        " seq INTEGER NOT NULL,"
+        " row_json TEXT NOT NULL,"
+        " PRIMARY KEY (table_name, bucket_key, month_year, row_id))"
+    )
+    # Fingerabdruck des zuletzt exportierten Inhalts pro Abrechnung
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS bucket_fingerprints ("
+        " table_name TEXT NOT NULL,"
+        " bucket_key TEXT NOT NULL,"
+        " month_year TEXT NOT NULL,"
+        " fingerprint TEXT NOT NULL,"
+        " exported_at TEXT NOT NULL,"
+        " PRIMARY KEY (table_name, bucket_key, month_year))"
+    )
+    # Offene Upload-Sitzungen (resumable) für Google Drive, Schlüssel enthält Ziel und MD5 der Datei
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS upload_sessions ("
+        " session_key TEXT PRIMARY KEY,"
+        " resumable_uri TEXT NOT NULL,"
+        " started_at TEXT NOT NULL)"
+    )
+    # Zeilen, deren Verarbeitung fehlgeschlagen ist (Wiederholungsliste); sie werden bei den nächsten
+    # Läufen zusätzlich zu den neuen Zeilen geholt, bis sie gelingen oder die Versuche aufgebraucht sind
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS failed_rows ("
+        " table_name TEXT NOT NULL,"
+        " row_id TEXT NOT NULL,"
+        " attempts INTEGER NOT NULL,"
+        " error TEXT NOT NULL,"
+        " failed_at TEXT NOT NULL,"
+        " PRIMARY KEY (table_name, row_id))"
+    )
+    return conn
+
+# Funktion zum Prüfen, ob eine Vollsynchronisation erzwungen wird (SYNC_FULL_REFRESH=1)
+def full_refresh_requested():
+    return os.getenv("SYNC_FULL_REFRESH", "").lower() in ("1", "true", "yes")
+
+# Funktion zum Lesen der Hochwassermarke (created_date_time, id) einer Tabelle
+def get_high_water(table_name, db_path=None):
+    if full_refresh_requested():
+        return None
+    conn = connect_state(db_path)
+    try:
+        row = conn.execute(
+            "SELECT created_date_time, last_id FROM high_water WHERE table_name = ?",
+            (table_name,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row and row[0] in ('None', 'NaT', 'nan', ''):
+        # Von älteren Versionen gespeicherte ungültige Marke: wie ohne Marke vollständig holen
+        logger.warning("Ungültige Hochwassermarke für %s (%s), hole alle Zeilen.", table_name, row[0])
+        return None
+    return tuple(row) if row else None
+
+# Funktion zum Speichern der Hochwassermarke nach erfolgreicher Synchronisation.
+# Ein Cursor ohne Zeitstempel wird nie gespeichert (er würde jeden weiteren Lauf scheitern lassen).
+def set_high_water(table_name, cursor, db_path=None):
+    if cursor is None or is_missing(cursor[0]):
+        logger.warning("Keine gültige Hochwassermarke für %s, bleibt unverändert.", table_name)
+        return
+    created_date_time, last_id = cursor
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO high_water (table_name, created_date_time, last_id, synced_at)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(table_name) DO UPDATE SET"
+                " created_date_time = excluded.created_date_time,"
+                " last_id = excluded.last_id,"
+                " synced_at = excluded.synced_at",
+                (table_name, str(created_date_time), str(last_id), datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+
+# Funktion zum Ermitteln der maximalen Anzahl Versuche pro Zeile (SYNC_ROW_MAX_ATTEMPTS)
+def max_row_attempts():
+    return max(1, int(os.getenv("SYNC_ROW_MAX_ATTEMPTS", 5)))
+
+# Funktion zum Lesen der IDs fehlgeschlagener Zeilen, die noch Versuche übrig haben
+def get_retry_ids(table_name, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT row_id FROM failed_rows WHERE table_name = ? AND attempts < ? ORDER BY failed_at",
+            (table_name, max_row_attempts())
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row_id for (row_id,) in rows]
+
+# Funktion zum Nachführen der Wiederholungsliste: verarbeitete Zeilen ohne Fehler werden entfernt,
+# fehlgeschlagene (failures: ID -> Fehlermeldung) eingetragen bzw. ihre Versuche hochgezählt.
+# Zeilen ohne Versuche bleiben zur Kontrolle stehen, werden aber nicht mehr geholt.
+def record_row_results(table_name, processed_ids, failures, db_path=None):
+    failures = {normalize_id(row_id): str(error) for row_id, error in failures.items()}
+    succeeded = {normalize_id(row_id) for row_id in processed_ids} - set(failures)
+    now = datetime.now().isoformat()
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                "DELETE FROM failed_rows WHERE table_name = ? AND row_id = ?",
+                [(table_name, row_id) for row_id in succeeded]
+            )
+            conn.executemany(
+                "INSERT INTO failed_rows (table_name, row_id, attempts, error, failed_at) VALUES (?, ?, 1, ?, ?)"
+                " ON CONFLICT(table_name, row_id) DO UPDATE SET"
+                " attempts = attempts + 1, error = excluded.error, failed_at = excluded.failed_at",
+                [(table_name, row_id, error, now) for row_id, error in failures.items()]
+            )
+            exhausted = conn.execute(
+                "SELECT row_id, error FROM failed_rows WHERE table_name = ? AND failed_at = ? AND attempts = ?",
+                (table_name, now, max_row_attempts())
+            ).fetchall()
+    finally:
+        conn.close()
+    for row_id, error in exhausted:
+        logger.warning("Zeile %s in %s nach %d Versuchen aufgegeben: %s", row_id, table_name,
+                       max_row_attempts(), error)
+
+# Funktion zum Prüfen, ob ein Wert fehlt (None, NaN oder NaT)
+def is_missing(value):
+    return value is None or value != value
+
+# Funktion zum Ermitteln der neuen Hochwassermarke aus den (sortiert) abgerufenen Rohdaten:
+# die letzte Zeile mit Zeitstempel, None wenn keine Zeile einen hat
+def high_water_from(df):
+    with_timestamp = df[df['created_date_time'].notna()]
+    if with_timestamp.empty:
+        return None
+    last_row = with_timestamp.iloc[-1]
+    return (last_row['created_date_time'], last_row['id'])
+
+# Funktion zum Vereinheitlichen einer ID (aus Excel gelesene IDs können float sein)
+def normalize_id(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if hasattr(value, 'item'):
+        value = value.item()
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+    return str(value)
+
+# Funktion zum JSON-kompatiblen Umwandeln eines Zellwerts (NaN -> null)
+def json_value(value):
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+# Funktion zum Einfügen/Aktualisieren der Zeilen einer Abrechnung (Upsert nach ID)
+def upsert_bucket_rows(table_name, bucket_key, month_year, rows, db_path=None):
+    columns = list(rows.columns)
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM bucket_rows"
+                " WHERE table_name = ? AND bucket_key = ? AND month_year = ?",
+                (table_name, str(bucket_key), month_year)
+            ).fetchone()[0]
+            records = []
+            for values in rows.itertuples(index=False, name=None):
+                seq += 1
+                row = {column: json_value(value) for column, value in zip(columns, values)}
+                records.append((table_name, str(bucket_key), month_year, normalize_id(row['ID']), seq,
+                                json.dumps(row, ensure_ascii=False, default=str)))
+            conn.executemany(
+                "INSERT INTO bucket_rows (table_name, bucket_key, month_year, row_id, seq, row_json)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(table_name, bucket_key, month_year, row_id) DO UPDATE SET"
+                " seq = excluded.seq, row_json = excluded.row_json",
+                records
+            )
+    finally:
+        conn.close()
+
+# Funktion zum Prüfen, ob für eine Abrechnung bereits Zeilen gespeichert sind
+def bucket_has_rows(table_name, bucket_key, month_year, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        row = conn.execute(
+            "SELECT 1 FROM bucket_rows WHERE table_name = ? AND bucket_key = ? AND month_year = ? LIMIT 1",
+            (table_name, str(bucket_key), month_year)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row is not None
+
+# Funktion zum Laden aller Zeilen einer Abrechnung in der gespeicherten Reihenfolge
+def load_bucket_rows(table_name, bucket_key, month_year, columns, db_path=None):
+    import pandas as pd
+
+    conn = connect_state(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT row_json FROM bucket_rows WHERE table_name = ? AND bucket_key = ? AND month_year = ?"
+            " ORDER BY seq",
+            (table_name, str(bucket_key), month_year)
+        ).fetchall()
+    finally:
+        conn.close()
+    return pd.DataFrame([json.loads(row_json) for (row_json,) in rows], columns=columns)
+
+# Funktion zum einmaligen Übernehmen einer bestehenden Excel-Datei in den Zeilenspeicher
+# (für Abrechnungen, die vor der Einführung des Zeilenspeichers erstellt wurden)
+def import_workbook_rows(table_name, bucket_key, month_year, filename, skiprows, db_path=None):
+    import pandas as pd
+
+    existing_data = pd.read_excel(filename, skiprows=skiprows)
+    if not existing_data.empty and existing_data.iloc[-1]['ID'] == 'TOTAL':
+        existing_data = existing_data.iloc[:-1]
+    upsert_bucket_rows(table_name, bucket_key, month_year, existing_data, db_path)
+    logger.info("Bestehende Excel-Datei in den Zeilenspeicher übernommen: %s (%d Zeilen)", filename, len(existing_data))
+
+# Funktion zum Berechnen des Fingerabdrucks einer Abrechnung (Kopfblock + nach ID sortierte Zeilen)
+def bucket_fingerprint(header_rows, rows):
+    records = sorted(
+        ([json_value(value) for value in values] for values in rows.itertuples(index=False, name=None)),
+        key=lambda record: str(record[0])
+    )
+    payload = json.dumps([header_rows, list(rows.columns), records], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# Funktion zum Lesen des Fingerabdrucks des letzten Exports einer Abrechnung
+def get_bucket_fingerprint(table_name, bucket_key, month_year, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        row = conn.execute(
+            "SELECT fingerprint FROM bucket_fingerprints WHERE table_name = ? AND bucket_key = ? AND month_year = ?",
+            (table_name, str(bucket_key), month_year)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+# Funktion zum Speichern des Fingerabdrucks nach erfolgreichem Export und Upload
+def set_bucket_fingerprint(table_name, bucket_key, month_year, fingerprint, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO bucket_fingerprints"
+                " (table_name, bucket_key, month_year, fingerprint, exported_at) VALUES (?, ?, ?, ?, ?)",
+                (table_name, str(bucket_key), month_year, fingerprint, datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+
+# Drive verwirft Upload-Sitzungen nach einer Woche, ältere Einträge werden nicht mehr fortgesetzt
+UPLOAD_SESSION_MAX_AGE = timedelta(days=6)
+
+# Funktion zum Lesen der Sitzungs-URI eines unterbrochenen Uploads
+def get_upload_session(session_key, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "DELETE FROM upload_sessions WHERE started_at < ?",
+                ((datetime.now() - UPLOAD_SESSION_MAX_AGE).isoformat(),)
+            )
+        row = conn.execute(
+            "SELECT resumable_uri FROM upload_sessions WHERE session_key = ?",
+            (session_key,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+# Funktion zum Speichern der Sitzungs-URI, sobald Drive die Upload-Sitzung eröffnet hat
+def set_upload_session(session_key, resumable_uri, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO upload_sessions (session_key, resumable_uri, started_at) VALUES (?, ?, ?)",
+                (session_key, resumable_uri, datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+
+# Funktion zum Entfernen einer abgeschlossenen oder abgelaufenen Upload-Sitzung
+def delete_upload_session(session_key, db_path=None):
+    conn = connect_state(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM upload_sessions WHERE session_key = ?", (session_key,))
+    finally:
+        conn.close()